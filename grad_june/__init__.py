@@ -7,3 +7,4 @@ from .model import GradJune
 from .timer import Timer
 from .policies import Policies
 from .runner import Runner
+from .ensemble import EnsembleRunner
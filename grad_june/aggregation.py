@@ -0,0 +1,112 @@
+import numpy as np
+import torch
+
+
+class Aggregator:
+    """
+    Breaks down per agent quantities (cases, deaths, ...) by agent categories.
+    The category of each agent for every attribute is encoded once as an
+    integer code, with the codes of the different attributes offset so that
+    they share a single index space. Each breakdown is then a single
+    `index_add` over all the attributes at once, which is differentiable with
+    respect to the aggregated values.
+
+    Parameters
+    ----------
+    data:
+        graph with the agent attributes to aggregate by.
+    attributes:
+        agent attributes to aggregate by. "age" is binned with `age_bins`,
+        the rest of attributes are categorical (e.g. sex, ethnicity, area,
+        super_area, socioeconomic_index).
+    age_bins:
+        edges of the age bins. An agent is in the bin (lo, hi) if
+        lo < age < hi.
+    device:
+        device where the codes are stored.
+    """
+
+    def __init__(
+        self, data, attributes=("age",), age_bins=(0, 18, 65, 100), device="cpu"
+    ):
+        self.attributes = tuple(attributes)
+        self.age_bins = torch.tensor(age_bins, device=device)
+        self.device = device
+        self.labels = {}
+        codes = []
+        offset = 0
+        for attribute in self.attributes:
+            attribute_codes, labels = self._get_codes(data, attribute)
+            self.labels[attribute] = labels
+            # agents out of every category go to an extra bucket that is dropped
+            attribute_codes[attribute_codes < 0] = len(labels)
+            codes.append(attribute_codes + offset)
+            offset += len(labels) + 1
+        self.n_codes = offset
+        self.codes = torch.cat(codes).to(device)
+
+    def _get_codes(self, data, attribute):
+        values = data["agent"][attribute]
+        if attribute == "age":
+            return self._get_age_codes(values)
+        if torch.is_tensor(values):
+            labels, codes = torch.unique(values, return_inverse=True)
+            return codes.long(), labels.tolist()
+        labels, codes = np.unique(np.asarray(values), return_inverse=True)
+        return torch.tensor(codes, dtype=torch.long), list(labels)
+
+    def _get_age_codes(self, ages):
+        ages = ages.to(self.device)
+        codes = -torch.ones(len(ages), dtype=torch.long, device=self.device)
+        for i in range(1, self.age_bins.shape[0]):
+            mask = (ages < self.age_bins[i]) & (ages > self.age_bins[i - 1])
+            codes[mask] = i - 1
+        labels = [int(age) for age in self.age_bins[1:]]
+        return codes, labels
+
+    def aggregate(self, values):
+        """
+        Sums the per agent values over every category of every attribute.
+        Leading dimensions of values are kept, so several quantities can be
+        aggregated in the same pass.
+
+        Returns
+        -------
+        dictionary mapping each attribute to a tensor of shape
+        (..., n_categories).
+        """
+        values = values.float()
+        n_attributes = len(self.attributes)
+        ret = torch.zeros((*values.shape[:-1], self.n_codes), device=values.device)
+        values = values.tile(*([1] * (values.dim() - 1)), n_attributes)
+        return self._split(ret.index_add(-1, self.codes, values))
+
+    def aggregate_stages(self, stages, n_stages):
+        """
+        Counts the agents at each symptom stage for every category, with a
+        single scatter over the (category, stage) pairs. Leading dimensions of
+        stages (e.g. ensemble members) are kept.
+
+        Returns
+        -------
+        dictionary mapping each attribute to a tensor of shape
+        (..., n_stages, n_categories).
+        """
+        stages = stages.detach().long()
+        stages = stages.tile(*([1] * (stages.dim() - 1)), len(self.attributes))
+        index = self.codes * n_stages + stages
+        ret = torch.zeros(
+            (*stages.shape[:-1], self.n_codes * n_stages), device=stages.device
+        )
+        ret = ret.scatter_add(-1, index, torch.ones_like(index, dtype=ret.dtype))
+        ret = ret.reshape(*stages.shape[:-1], self.n_codes, n_stages)
+        return self._split(ret.transpose(-1, -2))
+
+    def _split(self, aggregated):
+        ret = {}
+        offset = 0
+        for attribute in self.attributes:
+            n_labels = len(self.labels[attribute])
+            ret[attribute] = aggregated[..., offset : offset + n_labels]
+            offset += n_labels + 1
+        return ret
@@ -0,0 +1,92 @@
+import copy
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+
+from grad_june.runner import Runner
+from grad_june.utils import fix_seed, share_memory, update_parameters
+
+# world graph inherited by the forked workers
+_shared_data = None
+
+
+def _run_member(args):
+    overrides, seed, base_params = args
+    params = update_parameters(base_params, overrides)
+    fix_seed(seed)
+    # shallow copy, the graph tensors stay in shared memory and the agent
+    # state of this run is private to the worker
+    data = copy.copy(_shared_data)
+    runner = Runner.from_parameters(params, data=data)
+    with torch.no_grad():
+        results, is_infected = runner()
+    results = {
+        key: value if key == "dates" else value.detach().cpu().numpy()
+        for key, value in results.items()
+    }
+    return results
+
+
+def _initialize_worker():
+    # each worker runs one realization, avoid oversubscribing the cores
+    torch.set_num_threads(1)
+
+
+class EnsembleRunner:
+    """
+    Runs several realizations of the model in a pool of worker processes.
+    The world graph is loaded once, moved to shared memory and inherited by
+    the forked workers, which only allocate the state of their own runs.
+
+    Parameters
+    ----------
+    params:
+        base parameters, each run overrides some of them.
+    n_workers:
+        number of worker processes, defaults to the number of cores.
+    """
+
+    def __init__(self, params, n_workers=None):
+        self.params = params
+        self.n_workers = n_workers
+        self.data = share_memory(Runner.load_graph(params))
+
+    def run(self, parameter_list, seeds):
+        """
+        Runs the model once per (parameters, seed) pair. The parameters of
+        each run are nested dictionaries that override the base parameters,
+        e.g. {"networks": {"household": {"log_beta": 0.1}}}.
+
+        Returns
+        -------
+        list with the results of Runner.forward for each run, as numpy arrays.
+        """
+        global _shared_data
+        if len(parameter_list) != len(seeds):
+            raise ValueError("parameter_list and seeds must have the same length.")
+        _shared_data = self.data
+        tasks = [
+            (overrides, seed, self.params)
+            for overrides, seed in zip(parameter_list, seeds)
+        ]
+        context = mp.get_context("fork")
+        with context.Pool(self.n_workers, initializer=_initialize_worker) as pool:
+            results = pool.map(_run_member, tasks)
+        _shared_data = None
+        return results
+
+    @staticmethod
+    def to_dataframe(results):
+        """
+        Gathers the results of several runs into one table indexed by run
+        and date.
+        """
+        dfs = []
+        for run, run_results in enumerate(results):
+            df = pd.DataFrame(
+                {key: value for key, value in run_results.items() if key != "dates"},
+                index=pd.Index(run_results["dates"], name="date"),
+            )
+            df["run"] = run
+            dfs.append(df.reset_index())
+        return pd.concat(dfs).set_index(["run", "date"])
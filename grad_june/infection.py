@@ -1,6 +1,11 @@
 import torch
 
 class IsInfectedSampler(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self._uniform = None
+        self._new_infected = None
+
     def forward(self, not_infected_probs):
         """
         Here we need to sample the infection status of each agent and the variant that
@@ -10,30 +15,60 @@ class IsInfectedSampler(torch.nn.Module):
         the agent not getting infected, so that it can be sampled as an outcome using
         the Gumbel-Softmax reparametrization of the categorical distribution.
         """
-        logits = torch.vstack((not_infected_probs, 1.0 - not_infected_probs)).log()
+        logits = torch.stack((not_infected_probs, 1.0 - not_infected_probs)).log()
         infection = torch.nn.functional.gumbel_softmax(
             logits, dim=0, tau=0.1, hard=True
         )
-        is_infected = 1.0 - infection[0, :]
+        is_infected = 1.0 - infection[0]
         return is_infected
 
+    def sample(self, not_infected_probs):
+        """
+        Samples the new infections for runs that are not differentiated,
+        with plain Bernoulli draws instead of the Gumbel-Softmax trick.
+        Returns a boolean mask stored in a buffer that is reused (and
+        overwritten) by the next call.
+        """
+        if (
+            self._uniform is None
+            or self._uniform.shape != not_infected_probs.shape
+            or self._uniform.device != not_infected_probs.device
+        ):
+            self._uniform = torch.empty_like(not_infected_probs)
+            self._new_infected = torch.empty(
+                not_infected_probs.shape,
+                dtype=torch.bool,
+                device=not_infected_probs.device,
+            )
+        self._uniform.uniform_()
+        return torch.ge(self._uniform, not_infected_probs, out=self._new_infected)
+
 
 def infect_people(data, timer, new_infected):
+    susceptibility = data["agent"].susceptibility
     data["agent"].susceptibility = torch.clamp(
-        data["agent"].susceptibility - new_infected, min=0.0
-    )
-    data["agent"].is_infected = data["agent"].is_infected + new_infected
+        susceptibility - new_infected, min=0.0
+    ).to(susceptibility.dtype)
+    is_infected = data["agent"].is_infected
+    data["agent"].is_infected = (is_infected + new_infected).to(is_infected.dtype)
     data["agent"].infection_time = data["agent"].infection_time + new_infected * (
         timer.now - data["agent"].infection_time
     )
 
 
+def infect_people_(data, timer, new_infected):
+    """
+    In place version of infect_people for a boolean mask of new infections.
+    """
+    data["agent"].susceptibility.masked_fill_(new_infected, 0.0)
+    data["agent"].is_infected.add_(new_infected)
+    data["agent"].infection_time.masked_fill_(new_infected, timer.now)
+
+
 def infect_fraction_of_people(
     data, timer, symptoms_updater, fraction, device
 ):
-    n_infections = data["agent"].susceptibility.shape[0]
-    n_agents = data["agent"].id.shape[0]
-    probs = fraction * torch.ones(n_agents, device=device)
+    probs = fraction * torch.ones(data["agent"].susceptibility.shape, device=device)
     sampler = IsInfectedSampler()
     new_infected = sampler(
         1.0 - probs
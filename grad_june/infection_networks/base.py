@@ -5,93 +5,298 @@ from torch.utils.checkpoint import checkpoint
 from torch_geometric.nn.conv import MessagePassing
 
 from grad_june.paths import default_config_path
+from grad_june.utils import get_propagation_index, get_reverse_edge_index
+from grad_june.infection_networks.incidence import Incidence
+from grad_june.infection_networks.step_cache import StepCache
 import grad_june.infection_networks
 
 
 class InfectionNetwork(MessagePassing):
-    def __init__(self, log_beta, device="cpu"):
+    backends = ("message_passing", "edges", "sparse")
+    uses_quarantine = True
+
+    def __init__(self, log_beta, device="cpu", backend="message_passing"):
         super().__init__( aggr="add", node_dim=-1)
         self.device = device
         if type(log_beta) != torch.nn.Parameter:
-            self.log_beta = torch.tensor(float(log_beta))
+            # one value per ensemble member if a list is given
+            self.log_beta = torch.as_tensor(log_beta, dtype=torch.float)
         else:
             self.log_beta = log_beta
         self.name = self._get_name()
+        if backend not in self.backends:
+            raise ValueError(
+                f"Propagation backend {backend} not supported, "
+                f"use one of {self.backends}."
+            )
+        self.backend = backend
+        self._incidence = None
+        self._incidence_edge_index = None
+        self.register_buffer("p_contact", None, persistent=False)
+        self._p_contact_people = None
 
     @classmethod
     def from_parameters(cls, params):
         device = params["system"]["device"]
-        return cls(device=device, **params["networks"][cls._get_name()])
+        backend = params["system"].get("propagation_backend", "message_passing")
+        return cls(
+            device=device, backend=backend, **params["networks"][cls._get_name()]
+        )
 
     @classmethod
     def _get_name(cls):
         return "_".join(re.findall("[A-Z][^A-Z]*", cls.__name__)[:-1]).lower()
 
+    def _get_relation(self):
+        return "attends_" + self.name
+
     def _get_edge_index(self, data):
-        return data["attends_" + self.name].edge_index
+        return data[self._get_relation()].edge_index
 
     def _get_reverse_edge_index(self, data):
-        return data["rev_attends_" + self.name].edge_index
+        return get_reverse_edge_index(data, self._get_relation())
+
+    def _get_group_index(self, data):
+        """
+        Returns the group attended by each agent for networks where agents
+        attend at most one group (-1 for non members), None otherwise.
+        """
+        return data["agent"].get(f"{self.name}_group_index")
+
+    def _gather_from_groups(self, group_values, group_index):
+        """
+        Reverse pass for single membership networks. Each agent takes the
+        value of its group, and non members (index -1) pick the zero padding.
+        """
+        padding = torch.zeros(
+            (*group_values.shape[:-1], 1),
+            dtype=group_values.dtype,
+            device=group_values.device,
+        )
+        return torch.cat((group_values, padding), dim=-1)[..., group_index]
+
+    def _get_n_groups(self, data):
+        return len(data[self.name]["id"])
+
+    def _get_incidence(self, data):
+        """
+        Returns the CSR incidence of this network. It is built the first time
+        the network sees a graph and rebuilt only if the edge index changes.
+        """
+        edge_index = self._get_edge_index(data)
+        if self._incidence is None or self._incidence_edge_index is not edge_index:
+            self._incidence = Incidence(
+                edge_index,
+                n_agents=len(data["agent"].id),
+                n_groups=self._get_n_groups(data),
+            )
+            self._incidence_edge_index = edge_index
+        return self._incidence
 
     def _get_beta(self, policies, timer, data):
         interaction_policies = policies.interaction_policies
         beta = 10.0**self.log_beta
         if interaction_policies:
             beta = interaction_policies.apply(beta=beta, name=self.name, timer=timer)
-        beta = beta * torch.ones(len(data[self.name]["id"]), device=self.device)
         return beta
 
     def _get_people_per_group(self, data):
         return data[self.name]["people"]
 
-    def _get_transmissions(self, data, policies, timer):
-        if policies.quarantine_policies:
-            mask = policies.quarantine_policies.quarantine_mask
-        else:
-            mask = 1.0
-        return mask * data["agent"].transmission
+    def _get_quarantine_mask(self, policies):
+        if self.uses_quarantine and policies.quarantine_policies:
+            return policies.quarantine_policies.quarantine_mask
+        return 1.0
+
+    def _get_transmission_weights(self, data, timer):
+        """
+        Per-agent weights on the transmissions that only depend on the day
+        type, or None if there are none.
+        """
+        return None
+
+    def _get_susceptibility_weights(self, data, timer):
+        """
+        Per-agent weights on the susceptibilities that only depend on the day
+        type, or None if there are none.
+        """
+        return None
+
+    def _get_masked(self, key, data, policies, cache=None):
+        """
+        Returns the quarantine masked agent attribute `key`, shared through the
+        step cache by all the networks that use the same mask.
+        """
+
+        def compute():
+            values = data["agent"][key]
+            if values.element_size() < 4:
+                # reduced precision storage, accumulate in float32
+                values = values.float()
+            return self._get_quarantine_mask(policies) * values
+
+        if cache is None:
+            return compute()
+        return cache.get((key, self.uses_quarantine), compute)
+
+    def _get_weighted(self, key, weights, data, policies, cache=None):
+        def compute():
+            masked = self._get_masked(key, data=data, policies=policies, cache=cache)
+            if weights is None:
+                return masked
+            return weights * masked
+
+        if cache is None or weights is None:
+            return compute()
+        return cache.get((key, self.uses_quarantine, id(weights)), compute)
+
+    def _get_transmissions(self, data, policies, timer, cache=None):
+        weights = self._get_transmission_weights(data=data, timer=timer)
+        return self._get_weighted(
+            "transmission", weights, data=data, policies=policies, cache=cache
+        )
 
-    def _get_susceptibilities(self, data, policies, timer):
-        if policies.quarantine_policies:
-            mask = policies.quarantine_policies.quarantine_mask
-        else:
-            mask = 1.0
-        return mask * data["agent"].susceptibility
+    def _get_susceptibilities(self, data, policies, timer, cache=None):
+        weights = self._get_susceptibility_weights(data=data, timer=timer)
+        return self._get_weighted(
+            "susceptibility", weights, data=data, policies=policies, cache=cache
+        )
 
-    def forward(self, data, timer, policies):
-        beta = self._get_beta(policies=policies, timer=timer, data=data)
+    def _get_p_contact(self, data):
+        """
+        Returns the contact probability of each group. The group sizes do not
+        change during a run, so it is computed once and only recomputed if
+        the graph is replaced.
+        """
         people_per_group = self._get_people_per_group(data)
-        p_contact = torch.maximum(
-            torch.minimum(
-                1.0 / (people_per_group - 1), torch.tensor(1.0, device=self.device)
-            ),
-            torch.tensor(0.0, device=self.device),
-        )  # assumes constant n of contacts, change this in the future
-        beta = beta * p_contact
+        if self.p_contact is None or self._p_contact_people is not people_per_group:
+            # assumes constant n of contacts, change this in the future
+            self.p_contact = torch.clamp(
+                1.0 / (people_per_group - 1), min=0.0, max=1.0
+            ).to(self.device)
+            self._p_contact_people = people_per_group
+        return self.p_contact
+
+    def _get_group_beta(self, policies, timer, data):
+        """
+        Returns the beta of each group, the scalar beta of the network
+        broadcast over the contact probabilities of its groups.
+        """
+        beta = self._get_beta(policies=policies, timer=timer, data=data)
+        if torch.is_tensor(beta) and beta.dim() > 0:
+            # per ensemble member betas
+            beta = beta.unsqueeze(-1)
+        return beta * self._get_p_contact(data)
+
+    def forward(self, data, timer, policies, cache=None):
+        """
+        Returns the infection pressure on each agent from this network.
+        The step cache, if given, provides the masked agent values shared
+        with the other networks. If it has active agents, only their edges are
+        used to compute the group transmissions, and if it has susceptible
+        agents the pressure is only evaluated for those. The result is the
+        same as long as every other agent has zero transmission
+        (susceptibility), but gradients through the agents left out are not
+        propagated.
+        """
+        if cache is None:
+            cache = StepCache()
+        active_agents = cache.active_agents
+        susceptible_agents = cache.susceptible_agents
+        beta = self._get_group_beta(policies=policies, timer=timer, data=data)
         # remove people who are not really in this group
         transmissions = self._get_transmissions(
-            data=data, policies=policies, timer=timer
+            data=data, policies=policies, timer=timer, cache=cache
         )
         susceptibilities = self._get_susceptibilities(
-            data=data, policies=policies, timer=timer
+            data=data, policies=policies, timer=timer, cache=cache
         )
+        use_incidence = (
+            self.backend == "sparse"
+            or active_agents is not None
+            or susceptible_agents is not None
+        )
+        group_index = self._get_group_index(data)
+        if use_incidence and group_index is None:
+            return self._get_incidence(data).propagate(
+                transmissions,
+                beta,
+                susceptibilities,
+                active_agents=active_agents,
+                susceptible_agents=susceptible_agents,
+            )
         edge_index = self._get_edge_index(data)
-        cumulative_trans = self.propagate(edge_index, x=transmissions, y=beta)
-        rev_edge_index = self._get_reverse_edge_index(data)
+        if use_incidence:
+            cumulative_trans = beta * self._get_incidence(data).to_groups(
+                transmissions, agents=active_agents
+            )
+        elif self.backend == "edges":
+            cumulative_trans = self._propagate_edges(
+                edge_index, x=transmissions, y=beta
+            )
+        else:
+            cumulative_trans = self.propagate(
+                get_propagation_index(edge_index), x=transmissions, y=beta
+            )
+        if group_index is not None:
+            return susceptibilities * self._gather_from_groups(
+                cumulative_trans, group_index
+            )
+        if self.backend == "edges":
+            # the reverse pass runs over the same edges, no transpose is stored
+            return self._propagate_edges(
+                edge_index, x=cumulative_trans, y=susceptibilities, reverse=True
+            )
         trans_susc = self.propagate(
-            rev_edge_index, x=cumulative_trans, y=susceptibilities
+            get_propagation_index(edge_index, reverse=True),
+            x=cumulative_trans,
+            y=susceptibilities,
         )
         return trans_susc
 
     def message(self, x_j, y_i):
         return x_j * y_i
 
+    @staticmethod
+    def _propagate_edges(edge_index, x, y, reverse=False):
+        """
+        Sums the messages `x_j * y_i` of the edges (j, i) into their target
+        nodes i, along the last dimension, as the "edges" backend. With
+        `reverse`, the edges are followed from the second row to the first
+        one. The edge index is used in its storage dtype, both index_select
+        and index_add take int32 indices, so unlike `propagate` no int64 copy
+        or transpose of the edges is made.
+        """
+        sources, targets = edge_index[0], edge_index[1]
+        if reverse:
+            sources, targets = targets, sources
+        messages = x.index_select(-1, sources) * y.index_select(-1, targets)
+        ret = torch.zeros(
+            (*messages.shape[:-1], y.shape[-1]),
+            dtype=messages.dtype,
+            device=messages.device,
+        )
+        return ret.index_add(-1, targets, messages)
+
 
 class InfectionNetworks(torch.nn.Module):
-    def __init__(self, device="cpu", **kwargs):
+    def __init__(
+        self,
+        device="cpu",
+        fuse_shared_edges=False,
+        fuse_activities=False,
+        active_set_threshold=None,
+        susceptible_set_threshold=None,
+        **kwargs,
+    ):
         super().__init__()
         self.networks = torch.nn.ModuleDict(kwargs)
         self.device = device
+        self.fuse_shared_edges = fuse_shared_edges
+        self.fuse_activities = fuse_activities
+        self._activity_incidences = {}
+        self.active_set_threshold = active_set_threshold
+        self.susceptible_set_threshold = susceptible_set_threshold
 
     def __getitem__(self, item):
         return self.networks[item]
@@ -107,7 +312,16 @@ class InfectionNetworks(torch.nn.Module):
             network_class = getattr(grad_june.infection_networks, network_name)
             network = network_class.from_parameters(params)
             network_dict[key] = network
-        return cls(device=device, **network_dict)
+        return cls(
+            device=device,
+            fuse_shared_edges=params["system"].get("fuse_shared_edges", False),
+            fuse_activities=params["system"].get("fuse_activities", False),
+            active_set_threshold=params["system"].get("active_set_threshold"),
+            susceptible_set_threshold=params["system"].get(
+                "susceptible_set_threshold"
+            ),
+            **network_dict,
+        )
 
     @classmethod
     def from_file(cls, fpath=default_config_path):
@@ -121,18 +335,55 @@ class InfectionNetworks(torch.nn.Module):
         timer,
         policies,
     ):
-        n_agents = len(data["agent"].id)
         delta_time = timer.duration
         policies.apply(timer=timer, data=data)
-        trans_susc = torch.zeros(n_agents, device=self.device)
+        # (n_agents,) or (ensemble_size, n_agents)
+        trans_susc = torch.zeros(data["agent"].susceptibility.shape, device=self.device)
         activity_order = timer.get_activity_order()
         if policies.close_venue_policies:
             activity_order = policies.close_venue_policies.apply(
                 edge_types=activity_order, timer=timer
             )
-        for activity in activity_order:
-            network = self.networks[activity]
-            trans_susc += network(data=data, timer=timer, policies=policies)
+        cache = StepCache(
+            active_agents=self._get_active_agents(data),
+            susceptible_agents=self._get_susceptible_agents(data),
+        )
+        if self.fuse_activities:
+            if activity_order:
+                trans_susc += self._propagate_activities(
+                    activity_order,
+                    data=data,
+                    timer=timer,
+                    policies=policies,
+                    cache=cache,
+                )
+        elif self.fuse_shared_edges:
+            for activities in self._group_by_edges(data, activity_order):
+                networks = [self.networks[activity] for activity in activities]
+                if len(networks) == 1:
+                    trans_susc += networks[0](
+                        data=data,
+                        timer=timer,
+                        policies=policies,
+                        cache=cache,
+                    )
+                else:
+                    trans_susc += self._propagate_fused(
+                        networks,
+                        data=data,
+                        timer=timer,
+                        policies=policies,
+                        cache=cache,
+                    )
+        else:
+            for activity in activity_order:
+                network = self.networks[activity]
+                trans_susc += network(
+                    data=data,
+                    timer=timer,
+                    policies=policies,
+                    cache=cache,
+                )
         trans_susc = torch.clamp(
             trans_susc, min=1e-6, max = 100
         )  # this is necessary to avoid gradient nans
@@ -140,15 +391,227 @@ class InfectionNetworks(torch.nn.Module):
         not_infected_probs = torch.clamp(not_infected_probs, min=0.0, max=1.0)
         return not_infected_probs
 
+    def _get_active_agents(self, data):
+        """
+        Returns the indices of the agents with non-zero transmission, or None
+        if the active set mode is off or their fraction is above the threshold,
+        in which case propagating over all the edges is cheaper. The set is
+        only used without autograd, since the gradients reach the agents with
+        zero transmission through the sampled infections.
+        """
+        if torch.is_grad_enabled():
+            return None
+        return self._get_nonzero_agents(
+            data["agent"].transmission, self.active_set_threshold
+        )
+
+    def _get_susceptible_agents(self, data):
+        """
+        Returns the indices of the agents that can still be infected, or None
+        if the mode is off or their fraction is above the threshold. The set
+        is taken from the current susceptibilities, so it shrinks as agents
+        get infected, recover or die. Like the active set, it is only used
+        without autograd, so gradients are always taken over the full graph.
+        """
+        if torch.is_grad_enabled():
+            return None
+        return self._get_nonzero_agents(
+            data["agent"].susceptibility, self.susceptible_set_threshold
+        )
 
-class HouseholdNetwork(InfectionNetwork):
-    def _get_transmissions(self, data, policies, timer):
-        return data["agent"].transmission
+    @staticmethod
+    def _get_nonzero_agents(values, threshold):
+        if threshold is None:
+            return None
+        n_agents = values.shape[-1]
+        is_nonzero = (values != 0).reshape(-1, n_agents).any(0)
+        agents = torch.nonzero(is_nonzero).squeeze(-1)
+        if len(agents) > threshold * n_agents:
+            return None
+        return agents
+
+    def _group_by_edges(self, data, activity_order):
+        """
+        Groups the activities whose networks propagate over the same edges,
+        like the leisure networks sharing `attends_leisure`.
+        """
+        groups = {}
+        for activity in activity_order:
+            edge_index = self.networks[activity]._get_edge_index(data)
+            groups.setdefault(id(edge_index), []).append(activity)
+        return list(groups.values())
+
+    def _propagate_fused(self, networks, data, timer, policies, cache):
+        """
+        Propagates several networks sharing the same edges in a single sparse
+        pass, stacking their masked transmissions as channels.
+        Returns the summed trans_susc of all the networks.
+        """
+        incidence = networks[0]._get_incidence(data)
+        transmissions = torch.stack(
+            [
+                network._get_transmissions(
+                    data=data, policies=policies, timer=timer, cache=cache
+                )
+                for network in networks
+            ]
+        )
+        susceptibilities = torch.stack(
+            [
+                network._get_susceptibilities(
+                    data=data, policies=policies, timer=timer, cache=cache
+                )
+                for network in networks
+            ]
+        )
+        betas = torch.stack(
+            self._broadcast_betas(
+                [
+                    network._get_group_beta(policies=policies, timer=timer, data=data)
+                    for network in networks
+                ]
+            )
+        )
+        trans_susc = incidence.propagate(
+            transmissions,
+            betas,
+            susceptibilities,
+            active_agents=cache.active_agents,
+            susceptible_agents=cache.susceptible_agents,
+        )
+        return trans_susc.sum(0)
+
+    def _get_activity_incidence(self, activities, data, timer):
+        """
+        Returns the block incidence of all the networks of a time step, with
+        their group spaces stacked one after the other. Agents appear once
+        per quarantine variant, since some networks ignore the quarantine
+        mask, and the static weights of each network (e.g. the leisure
+        probabilities) are stored in its edges. It is cached by activity set
+        and day type and rebuilt if any edge index changes.
+        """
+        networks = [self.networks[activity] for activity in activities]
+        edge_indices = tuple(network._get_edge_index(data) for network in networks)
+        key = (tuple(activities), timer.day_type)
+        if key in self._activity_incidences:
+            cached_edge_indices, incidence, variants = self._activity_incidences[key]
+            if all(a is b for a, b in zip(cached_edge_indices, edge_indices)):
+                return incidence, variants
+        n_agents = len(data["agent"].id)
+        variants = sorted(set(network.uses_quarantine for network in networks))
+        agents, groups = [], []
+        transmission_weights, susceptibility_weights = [], []
+        group_offset = 0
+        for network, edge_index in zip(networks, edge_indices):
+            network_agents = edge_index[0].long()
+            variant = variants.index(network.uses_quarantine)
+            agents.append(network_agents + variant * n_agents)
+            groups.append(edge_index[1].long() + group_offset)
+            transmission_weights.append(
+                self._get_edge_weights(
+                    network._get_transmission_weights(data=data, timer=timer),
+                    network_agents,
+                )
+            )
+            susceptibility_weights.append(
+                self._get_edge_weights(
+                    network._get_susceptibility_weights(data=data, timer=timer),
+                    network_agents,
+                )
+            )
+            group_offset += network._get_n_groups(data)
+        incidence = Incidence(
+            torch.vstack((torch.cat(agents), torch.cat(groups))),
+            n_agents=len(variants) * n_agents,
+            n_groups=group_offset,
+            transmission_weights=torch.cat(transmission_weights),
+            susceptibility_weights=torch.cat(susceptibility_weights),
+            index_dtype=edge_indices[0].dtype,
+        )
+        self._activity_incidences[key] = (edge_indices, incidence, variants)
+        return incidence, variants
+
+    @staticmethod
+    def _get_edge_weights(agent_weights, agents):
+        if agent_weights is None:
+            return torch.ones(len(agents), device=agents.device)
+        return agent_weights[agents].to(torch.float)
+
+    @staticmethod
+    def _broadcast_betas(betas):
+        """
+        Expands the group betas of several networks to the same leading
+        (ensemble) dimensions, when only some networks have per member betas.
+        """
+        shape = torch.broadcast_shapes(*(beta.shape[:-1] for beta in betas))
+        return [beta.expand(*shape, beta.shape[-1]) for beta in betas]
+
+    @staticmethod
+    def _expand_variants(agents, n_variants, n_agents):
+        if agents is None:
+            return None
+        return torch.cat([agents + i * n_agents for i in range(n_variants)])
+
+    def _propagate_activities(self, activities, data, timer, policies, cache):
+        """
+        Propagates all the activities of a time step with two sparse products
+        over their block incidence. Returns the summed trans_susc.
+        """
+        networks = [self.networks[activity] for activity in activities]
+        incidence, variants = self._get_activity_incidence(
+            activities, data=data, timer=timer
+        )
+        n_agents = len(data["agent"].id)
+        variant_networks = [
+            next(n for n in networks if n.uses_quarantine == uses_quarantine)
+            for uses_quarantine in variants
+        ]
+        transmissions = torch.cat(
+            [
+                network._get_masked(
+                    "transmission", data=data, policies=policies, cache=cache
+                )
+                for network in variant_networks
+            ],
+            dim=-1,
+        )
+        susceptibilities = torch.cat(
+            [
+                network._get_masked(
+                    "susceptibility", data=data, policies=policies, cache=cache
+                )
+                for network in variant_networks
+            ],
+            dim=-1,
+        )
+        betas = torch.cat(
+            self._broadcast_betas(
+                [
+                    network._get_group_beta(policies=policies, timer=timer, data=data)
+                    for network in networks
+                ]
+            ),
+            dim=-1,
+        )
+        trans_susc = incidence.propagate(
+            transmissions,
+            betas,
+            susceptibilities,
+            active_agents=self._expand_variants(
+                cache.active_agents, len(variants), n_agents
+            ),
+            susceptible_agents=self._expand_variants(
+                cache.susceptible_agents, len(variants), n_agents
+            ),
+        )
+        trans_susc = trans_susc.reshape(
+            *trans_susc.shape[:-1], len(variants), n_agents
+        )
+        return trans_susc.sum(-2)
 
-    def _get_susceptibilities(self, data, policies, timer):
-        return data["agent"].susceptibility
 
-    pass
+class HouseholdNetwork(InfectionNetwork):
+    uses_quarantine = False
 
 
 class CareHomeNetwork(InfectionNetwork):
@@ -165,4 +628,3 @@ class CompanyNetwork(InfectionNetwork):
 
 class UniversityNetwork(InfectionNetwork):
     pass
-
@@ -0,0 +1,244 @@
+import torch
+
+
+class IncidenceProduct(torch.autograd.Function):
+    """
+    Sparse product `matrix @ x`. The backward pass multiplies by the
+    precomputed transpose, so no edge-sized tensors are kept for autograd.
+    """
+
+    @staticmethod
+    def forward(ctx, x, matrix, matrix_t):
+        ctx.matrix_t = matrix_t
+        return matrix @ x.contiguous()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return ctx.matrix_t @ grad_output.contiguous(), None, None
+
+
+class TwoStageProduct(torch.autograd.Function):
+    """
+    Agent to group to agent propagation `susc * (B @ (beta * (A @ trans)))`
+    on (channels, agents) inputs. Only the susceptibilities, the group sums
+    and the group betas are saved for backward, the agent sized products
+    are recomputed there with the precomputed transposes.
+    """
+
+    @staticmethod
+    def forward(ctx, transmissions, beta, susceptibilities, incidence):
+        group_sums = (incidence.agents_to_groups @ transmissions.T.contiguous()).T
+        pressure = incidence.groups_to_agents @ (beta * group_sums).T.contiguous()
+        ctx.incidence = incidence
+        ctx.shapes = (transmissions.shape, beta.shape, susceptibilities.shape)
+        ctx.save_for_backward(beta, susceptibilities, group_sums)
+        return susceptibilities * pressure.T
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_output):
+        beta, susceptibilities, group_sums = ctx.saved_tensors
+        incidence = ctx.incidence
+        trans_shape, beta_shape, susc_shape = ctx.shapes
+        grad_trans = grad_beta = grad_susc = None
+        if ctx.needs_input_grad[2]:
+            pressure = incidence.groups_to_agents @ (beta * group_sums).T.contiguous()
+            grad_susc = (grad_output * pressure.T).sum_to_size(susc_shape)
+        if ctx.needs_input_grad[0] or ctx.needs_input_grad[1]:
+            grad_cum = (
+                incidence.groups_to_agents_t
+                @ (grad_output * susceptibilities).T.contiguous()
+            ).T
+            if ctx.needs_input_grad[1]:
+                grad_beta = (grad_cum * group_sums).sum_to_size(beta_shape)
+            if ctx.needs_input_grad[0]:
+                grad_trans = (
+                    incidence.agents_to_groups_t @ (grad_cum * beta).T.contiguous()
+                ).T.sum_to_size(trans_shape)
+        return grad_trans, grad_beta, grad_susc, None
+
+
+def _make_csr(rows, cols, values, size, index_dtype=torch.long):
+    matrix = torch.sparse_coo_tensor(torch.vstack((rows, cols)), values, size)
+    matrix = matrix.coalesce().to_sparse_csr()
+    if index_dtype == torch.long:
+        return matrix
+    # the int64 indices of the conversion are only temporary
+    return torch.sparse_csr_tensor(
+        matrix.crow_indices().to(index_dtype),
+        matrix.col_indices().to(index_dtype),
+        matrix.values(),
+        size,
+    )
+
+
+class Incidence:
+    """
+    Agent-group incidence matrix of a network, stored in CSR layout together
+    with its transpose. It is built once from the `attends_*` edge index and
+    replaces the two message passing steps of the infection networks by
+    sparse matrix products.
+
+    Parameters
+    ----------
+    edge_index:
+        (2, n_edges) tensor with agent ids in the first row and group ids
+        in the second one.
+    n_agents:
+        number of agents in the world.
+    n_groups:
+        number of groups in the network.
+    transmission_weights:
+        optional weight of each edge when summing agents into groups.
+    susceptibility_weights:
+        optional weight of each edge when summing groups into agents.
+    index_dtype:
+        dtype of the CSR indices, that of the edge index by default (int32
+        for compact graphs).
+    """
+
+    def __init__(
+        self,
+        edge_index,
+        n_agents,
+        n_groups,
+        transmission_weights=None,
+        susceptibility_weights=None,
+        index_dtype=None,
+    ):
+        self.n_agents = n_agents
+        self.n_groups = n_groups
+        if index_dtype is None:
+            index_dtype = edge_index.dtype
+        agents, groups = edge_index[0].long(), edge_index[1].long()
+        ones = torch.ones(agents.shape[0], device=agents.device)
+        weights = ones if transmission_weights is None else transmission_weights
+        self.agents_to_groups = _make_csr(
+            groups, agents, weights, (n_groups, n_agents), index_dtype
+        )
+        self.agents_to_groups_t = _make_csr(
+            agents, groups, weights, (n_agents, n_groups), index_dtype
+        )
+        if transmission_weights is None and susceptibility_weights is None:
+            self.groups_to_agents = self.agents_to_groups_t
+            self.groups_to_agents_t = self.agents_to_groups
+        else:
+            weights = ones if susceptibility_weights is None else susceptibility_weights
+            self.groups_to_agents = _make_csr(
+                agents, groups, weights, (n_agents, n_groups), index_dtype
+            )
+            self.groups_to_agents_t = _make_csr(
+                groups, agents, weights, (n_groups, n_agents), index_dtype
+            )
+
+    @staticmethod
+    def _product(x, matrix, matrix_t):
+        """
+        Applies the matrix along the last dimension of x. Leading dimensions
+        are treated as independent channels.
+        """
+        batch_shape = x.shape[:-1]
+        x = x.to(matrix.dtype).reshape(-1, x.shape[-1]).T
+        ret = IncidenceProduct.apply(x, matrix, matrix_t)
+        return ret.T.reshape(*batch_shape, ret.shape[0])
+
+    def propagate(
+        self,
+        transmissions,
+        beta,
+        susceptibilities,
+        active_agents=None,
+        susceptible_agents=None,
+    ):
+        """
+        Returns the infection pressure `susceptibilities * to_agents(beta *
+        to_groups(transmissions))`. Leading dimensions are treated as
+        independent channels. Without agent subsets it runs as a single
+        autograd node that keeps no agent or edge sized products for backward.
+        """
+        if active_agents is not None or susceptible_agents is not None:
+            cumulative_trans = beta * self.to_groups(
+                transmissions, agents=active_agents
+            )
+            return susceptibilities * self.to_agents(
+                cumulative_trans, agents=susceptible_agents
+            )
+        dtype = self.agents_to_groups.dtype
+        batch_shape = torch.broadcast_shapes(
+            transmissions.shape[:-1], beta.shape[:-1], susceptibilities.shape[:-1]
+        )
+        ret = TwoStageProduct.apply(
+            self._flatten_channels(transmissions.to(dtype), batch_shape),
+            self._flatten_channels(beta.to(dtype), batch_shape),
+            self._flatten_channels(susceptibilities.to(dtype), batch_shape),
+            self,
+        )
+        return ret.reshape(*batch_shape, self.n_agents)
+
+    @staticmethod
+    def _flatten_channels(x, batch_shape):
+        """
+        Reshapes x to (channels, n) for the given leading shape. Inputs without
+        leading dimensions are kept as a single broadcast row.
+        """
+        if x.dim() > 1 and x.shape[:-1] != batch_shape:
+            x = x.expand(*batch_shape, x.shape[-1])
+        return x.reshape(-1, x.shape[-1])
+
+    def to_groups(self, x, agents=None):
+        """
+        Sums agent values into the groups they attend. If `agents` is given,
+        only the edges of those agents are visited, which is cheaper when the
+        rest of the agents have zero value.
+        """
+        if agents is None:
+            return self._product(x, self.agents_to_groups, self.agents_to_groups_t)
+        return self._subset_to_groups(x, agents)
+
+    @staticmethod
+    def _get_agent_edges(matrix, agents):
+        """
+        Returns the agent, group and weight of every edge of the given agents,
+        read from the row offsets of an (agents, groups) CSR matrix.
+        """
+        offsets = matrix.crow_indices()
+        # only the offsets of the subset are widened
+        starts = offsets[agents].long()
+        counts = offsets[agents + 1].long() - starts
+        first_edges = torch.cumsum(counts, 0) - counts
+        edges = torch.repeat_interleave(starts - first_edges, counts) + torch.arange(
+            int(counts.sum()), device=agents.device
+        )
+        edge_agents = torch.repeat_interleave(agents, counts)
+        groups = matrix.col_indices()[edges]
+        weights = matrix.values()[edges]
+        return edge_agents, groups, weights
+
+    def _subset_to_groups(self, x, agents):
+        edge_agents, groups, weights = self._get_agent_edges(
+            self.agents_to_groups_t, agents
+        )
+        values = x.to(weights.dtype)[..., edge_agents] * weights
+        ret = torch.zeros(
+            (*x.shape[:-1], self.n_groups), dtype=weights.dtype, device=x.device
+        )
+        return ret.index_add(-1, groups, values)
+
+    def to_agents(self, x, agents=None):
+        """
+        Sums group values into the agents attending them. If `agents` is
+        given, only those agents are evaluated and the rest are set to zero.
+        """
+        if agents is None:
+            return self._product(x, self.groups_to_agents, self.groups_to_agents_t)
+        return self._subset_to_agents(x, agents)
+
+    def _subset_to_agents(self, x, agents):
+        edge_agents, groups, weights = self._get_agent_edges(
+            self.groups_to_agents, agents
+        )
+        values = x.to(weights.dtype)[..., groups] * weights
+        ret = torch.zeros(
+            (*x.shape[:-1], self.n_agents), dtype=weights.dtype, device=x.device
+        )
+        return ret.index_add(-1, edge_agents, values)
@@ -5,8 +5,10 @@ from grad_june.utils import parse_age_probabilities
 
 
 class LeisureNetwork(InfectionNetwork):
-    def __init__(self, log_beta, leisure_probabilities, device):
-        super().__init__(log_beta=log_beta, device=device)
+    def __init__(
+        self, log_beta, leisure_probabilities, device, backend="message_passing"
+    ):
+        super().__init__(log_beta=log_beta, device=device, backend=backend)
         self.leisure_probabilities = self._parse_leisure_probabilities(
             leisure_probabilities
         )
@@ -16,9 +18,11 @@ class LeisureNetwork(InfectionNetwork):
     @classmethod
     def from_parameters(cls, params):
         device = params["system"]["device"]
+        backend = params["system"].get("propagation_backend", "message_passing")
         leisure_probabilities = params["leisure"][cls._get_name()]
         return cls(
             device=device,
+            backend=backend,
             leisure_probabilities=leisure_probabilities,
             **params["networks"][cls._get_name()]
         )
@@ -41,48 +45,32 @@ class LeisureNetwork(InfectionNetwork):
             1, data["agent"].sex, data["agent"].age
         ]
 
-    def _get_edge_index(self, data):
-        return data["attends_leisure"].edge_index
+    def _get_relation(self):
+        return "attends_leisure"
 
-    def _get_reverse_edge_index(self, data):
-        return data["rev_attends_leisure"].edge_index
+    def _get_group_index(self, data):
+        # people attend several leisure super areas
+        return None
 
-    def _get_beta(self, policies, timer, data):
-        interaction_policies = policies.interaction_policies
-        beta = 10.0**self.log_beta
-        if interaction_policies:
-            beta = interaction_policies.apply(beta=beta, name=self.name, timer=timer)
-        beta = beta * torch.ones(len(data["leisure"]["id"]), device=self.device)
-        return beta
+    def _get_n_groups(self, data):
+        return len(data["leisure"]["id"])
 
     def _get_people_per_group(self, data):
         return data["leisure"]["people"]
 
-    def _get_transmissions(self, data, policies, timer):
+    def _get_leisure_mask(self, data, timer):
         if self.weekday_probabilities is None:
             self.initialize_leisure_probabilities(data)
-        if policies.quarantine_policies:
-            mask = policies.quarantine_policies.quarantine_mask
-        else:
-            mask = 1.0
         if timer.day_type == "weekday":
-            leisure_mask = self.weekday_probabilities
+            return self.weekday_probabilities
         else:
-            leisure_mask = self.weekend_probabilities
-        return mask * leisure_mask * data["agent"].transmission
+            return self.weekend_probabilities
 
-    def _get_susceptibilities(self, data, policies, timer):
-        if self.weekday_probabilities is None:
-            self.initialize_leisure_probabilities(data)
-        if policies.quarantine_policies:
-            mask = policies.quarantine_policies.quarantine_mask
-        else:
-            mask = 1.0
-        if timer.day_type == "weekday":
-            leisure_mask = self.weekday_probabilities
-        else:
-            leisure_mask = self.weekend_probabilities
-        return mask * leisure_mask * data["agent"].susceptibility
+    def _get_transmission_weights(self, data, timer):
+        return self._get_leisure_mask(data=data, timer=timer)
+
+    def _get_susceptibility_weights(self, data, timer):
+        return self._get_leisure_mask(data=data, timer=timer)
 
 
 class PubNetwork(LeisureNetwork):
@@ -105,16 +93,16 @@ class VisitNetwork(LeisureNetwork):
     pass
 
 class CareVisitNetwork(LeisureNetwork):
-    def _get_susceptibilities(self, data, policies, timer):
+    def initialize_leisure_probabilities(self, data):
+        super().initialize_leisure_probabilities(data)
+        # only the elderly receive care visits
         mask_age = data["agent"].age > 75
+        self.susceptibility_weights = {
+            "weekday": self.weekday_probabilities * mask_age,
+            "weekend": self.weekend_probabilities * mask_age,
+        }
+
+    def _get_susceptibility_weights(self, data, timer):
         if self.weekday_probabilities is None:
             self.initialize_leisure_probabilities(data)
-        if policies.quarantine_policies:
-            mask = policies.quarantine_policies.quarantine_mask
-        else:
-            mask = 1.0
-        if timer.day_type == "weekday":
-            leisure_mask = self.weekday_probabilities
-        else:
-            leisure_mask = self.weekend_probabilities
-        return mask * leisure_mask * data["agent"].susceptibility * mask_age
+        return self.susceptibility_weights[timer.day_type]
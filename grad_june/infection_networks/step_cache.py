@@ -0,0 +1,31 @@
+class StepCache:
+    """
+    State shared by the infection networks during one time step.
+    InfectionNetworks fills it once per step with the agent sets used to
+    prune the propagation, and the masked transmissions and susceptibilities
+    are stored the first time a network asks for them, so that each
+    agent-sized product is computed once per step instead of once per network.
+
+    Parameters
+    ----------
+    active_agents:
+        indices of the agents with non-zero transmission, or None to use all.
+    susceptible_agents:
+        indices of the agents with non-zero susceptibility, or None to use all.
+    """
+
+    def __init__(self, active_agents=None, susceptible_agents=None):
+        self.active_agents = active_agents
+        self.susceptible_agents = susceptible_agents
+        self._values = {}
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key, compute):
+        """
+        Returns the value stored under key, computing it the first time.
+        """
+        if key not in self._values:
+            self._values[key] = compute()
+        return self._values[key]
@@ -27,6 +27,7 @@ class AgentDataLoader:
             area_ids = population["area"][:]
             area_names = f["geography"]["area_name"][:][area_ids].astype("U")
             data["agent"].area = area_names
+            data["agent"].super_area = torch.tensor(population["super_area"][:])
             sexes = population["sex"][:].astype(str).astype(object)
             sexes[sexes == "m"] = 0
             sexes[sexes == "f"] = 1
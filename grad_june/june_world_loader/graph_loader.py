@@ -1,4 +1,6 @@
-import torch_geometric.transforms as T
+import torch
+
+from grad_june.utils import cast_indices
 
 from grad_june.june_world_loader.household_loader import HouseholdNetworkLoader
 from grad_june.june_world_loader.care_home_loader import CareHomeNetworkLoader
@@ -9,9 +11,10 @@ from grad_june.june_world_loader.leisure_loader import LeisureNetworkLoader
 
 
 class GraphLoader:
-    def __init__(self, june_world_path, k_leisure=3):
+    def __init__(self, june_world_path, k_leisure=3, index_dtype=torch.long):
         self.june_world_path = june_world_path
         self.k_leisure = k_leisure
+        self.index_dtype = index_dtype
 
     def load_graph(
         self,
@@ -35,5 +38,7 @@ class GraphLoader:
                 self.june_world_path, k=self.k_leisure
             )
             leisure_loader.load_network(data)
-        data = T.ToUndirected()(data)
+        # the reverse edges are not stored, get_reverse_edge_index serves the
+        # transpose of the attends_* edges when they are needed.
+        data = cast_indices(data, self.index_dtype)
         return data
@@ -2,6 +2,9 @@ import h5py
 import torch
 from collections import defaultdict
 
+from grad_june.utils import get_agent_group_index
+
+
 class NetworkLoader:
     spec = None
     plural = None
@@ -27,6 +30,11 @@ class NetworkLoader:
             group_ids = f[self.plural]["id"][:]
         return group_ids
 
+    def _get_n_agents(self):
+        with h5py.File(self.june_world_path, "r") as f:
+            n_agents = len(f["population"]["id"])
+        return n_agents
+
     def load_network(self, data):
         people_per_group = self._get_people_per_group()
         adjlist_i = []
@@ -42,3 +50,6 @@ class NetworkLoader:
         edge_type = ("agent", f"attends_{self.spec}", self.spec)
         new_edges = torch.vstack((torch.tensor(adjlist_i), torch.tensor(adjlist_j)))
         data[edge_type].edge_index = new_edges
+        group_index = get_agent_group_index(new_edges, self._get_n_agents())
+        if group_index is not None:
+            data["agent"][f"{self.spec}_group_index"] = group_index
@@ -8,6 +8,7 @@ from grad_june import (
     SymptomsUpdater,
     InfectionNetworks,
 )
+from grad_june.infection import infect_people_
 from grad_june.policies import Policies
 from grad_june.cuda_utils import get_fraction_gpu_used
 from grad_june.paths import default_config_path
@@ -32,6 +33,7 @@ class GradJune(torch.nn.Module):
         policies=None,
         infection_networks=None,
         device="cpu",
+        transmission_updater=None,
     ):
         super().__init__()
 
@@ -47,7 +49,9 @@ class GradJune(torch.nn.Module):
         self.infection_networks = infection_networks
 
         # Initializes transmission updater, is_infected_sampler, and device.
-        self.transmission_updater = TransmissionUpdater()
+        if transmission_updater is None:
+            transmission_updater = TransmissionUpdater()
+        self.transmission_updater = transmission_updater
         self.is_infected_sampler = IsInfectedSampler()
         self.device = device
 
@@ -80,11 +84,13 @@ class GradJune(torch.nn.Module):
         symptoms_updater = SymptomsUpdater.from_parameters(params)
         policies = Policies.from_parameters(params)
         infection_networks = InfectionNetworks.from_parameters(params)
+        transmission_updater = TransmissionUpdater.from_parameters(params)
         return cls(
             symptoms_updater=symptoms_updater,
             policies=policies,
             infection_networks=infection_networks,
             device=params["system"]["device"],
+            transmission_updater=transmission_updater,
         )
 
     def infect_people(self, data, timer, new_infected):
@@ -100,11 +106,14 @@ class GradJune(torch.nn.Module):
             None.
         """
         # Updates agent susceptibility, infection status, and infection time based on new_infected tensor.
+        # The state is kept in its storage dtype, which may be reduced precision.
+        susceptibility = data["agent"].susceptibility
         data["agent"].susceptibility = torch.maximum(
             torch.tensor(0.0, device=self.device),
-            data["agent"].susceptibility - new_infected,
-        )
-        data["agent"].is_infected = data["agent"].is_infected + new_infected
+            susceptibility - new_infected,
+        ).to(susceptibility.dtype)
+        is_infected = data["agent"].is_infected
+        data["agent"].is_infected = (is_infected + new_infected).to(is_infected.dtype)
         data["agent"].infection_time = data["agent"].infection_time + new_infected * (
             timer.now - data["agent"].infection_time
         )
@@ -142,3 +151,28 @@ class GradJune(torch.nn.Module):
 
         # Returns updated simulation data.
         return data
+
+    def inference_step(self, data, timer):
+        """
+        Runs a time step for simulations that are not differentiated. Infections
+        are drawn with Bernoulli sampling and the agent state is updated in
+        place with boolean masks. It must run under torch.inference_mode or
+        torch.no_grad.
+
+        Args:
+            data: A PyTorch geometric data object containing simulation data.
+            timer: An integer representing the current simulation time.
+
+        Returns:
+            A PyTorch geometric data object containing updated simulation data.
+        """
+        data["agent"].transmission = self.transmission_updater(data=data, timer=timer)
+        not_infected_probs = self.infection_networks(
+            data=data,
+            timer=timer,
+            policies=self.policies,
+        )
+        new_infected = self.is_infected_sampler.sample(not_infected_probs)
+        infect_people_(data, timer, new_infected)
+        self.symptoms_updater.update_(data=data, timer=timer, new_infected=new_infected)
+        return data
@@ -1,5 +1,9 @@
+import copy
+import datetime
+import os
 import torch
 import pickle
+import warnings
 import numpy as np
 import pandas as pd
 from torch.utils.checkpoint import checkpoint
@@ -8,11 +12,22 @@ from pathlib import Path
 
 from grad_june.paths import default_config_path
 from grad_june import GradJune, Timer, TransmissionSampler
-from grad_june.utils import read_path
-from grad_june.infection import infect_fraction_of_people
+from grad_june.utils import (
+    read_path,
+    cast_indices,
+    get_dtype,
+    add_group_indices,
+    drop_reverse_edges,
+)
+from grad_june.infection import infect_fraction_of_people, infect_people_
+from grad_june.aggregation import Aggregator
+from grad_june.transmission import LazyInfectionParameters
 
 
 class Runner(torch.nn.Module):
+    state_keys = ("transmission", "susceptibility", "is_infected", "infection_time")
+    symptoms_keys = ("current_stage", "next_stage", "time_to_next_stage")
+
     def __init__(
         self,
         model,
@@ -22,17 +37,36 @@ class Runner(torch.nn.Module):
         save_path,
         parameters,
         age_bins=(0, 18, 65, 100),
+        aggregate_by=(),
+        aggregate_stages=False,
+        checkpoint_window=None,
+        inference=False,
+        state_path=None,
+        save_state_every=None,
     ):
         super().__init__()
         self.model = model
         self.data = data
-        self.data_backup = self.backup_infection_data(data)
         self.timer = timer
         self.log_fraction_initial_cases = log_fraction_initial_cases
         self.device = model.device
+        self.data_backup = self.backup_infection_data(data)
         self.age_bins = torch.tensor(age_bins, device=self.device)
         self.ethnicities = np.sort(np.unique(data["agent"].ethnicity))
         self.n_agents = data["agent"].id.shape[0]
+        self.aggregator = Aggregator(
+            data,
+            attributes=tuple(dict.fromkeys(("age", *aggregate_by))),
+            age_bins=age_bins,
+            device=self.device,
+        )
+        self._ethnicity_aggregator = None
+        self.aggregate_by = tuple(aggregate_by)
+        self.aggregate_stages = aggregate_stages
+        self.checkpoint_window = checkpoint_window
+        self.inference = inference
+        self.state_path = None if state_path is None else Path(state_path)
+        self.save_state_every = save_state_every
         self.population_by_age = self.get_people_by_age()
         self.save_path = Path(save_path)
         self.input_parameters = parameters
@@ -45,9 +79,17 @@ class Runner(torch.nn.Module):
         return cls.from_parameters(params)
 
     @classmethod
-    def from_parameters(cls, params):
+    def from_parameters(cls, params, data=None):
+        """
+        Builds the runner from the parameters. If `data` is given, it is used
+        as the world graph instead of loading it from `data_path`, and only
+        the agent state is initialized.
+        """
         model = GradJune.from_parameters(params)
-        data = cls.get_data(params)
+        if data is None:
+            data = cls.get_data(params)
+        else:
+            data = cls.initialize_agent_state(data, params)
         timer = Timer.from_parameters(params)
         age_bins_to_save = params.get("age_bins_to_save", (0, 18, 65, 100))
         return cls(
@@ -59,84 +101,164 @@ class Runner(torch.nn.Module):
             ],
             save_path=params["save_path"],
             parameters=params,
-            age_bins = age_bins_to_save
+            age_bins = age_bins_to_save,
+            aggregate_by=params.get("aggregate_by", ()),
+            aggregate_stages=params.get("aggregate_stages", False),
+            checkpoint_window=params["system"].get("checkpoint_window"),
+            inference=params["system"].get("inference", False),
+            state_path=params["system"].get("state_path"),
+            save_state_every=params["system"].get("save_state_every"),
         )
 
+    @classmethod
+    def get_data(cls, params):
+        return cls.initialize_agent_state(cls.load_graph(params), params)
+
     @staticmethod
-    def get_data(params):
+    def load_graph(params):
+        """
+        Loads the world graph with the static agent attributes. Reverse
+        edges saved in older graphs are dropped, see `get_reverse_edge_index`.
+        """
         device = params["system"]["device"]
+        index_dtype = get_dtype(params["system"].get("index_dtype", "int64"))
         data_path = read_path(params["data_path"])
         with open(data_path, "rb") as f:
             data = pickle.load(f).to(device)
+        data = drop_reverse_edges(data)
+        data = add_group_indices(data)
+        return cast_indices(data, index_dtype)
+
+    @staticmethod
+    def initialize_agent_state(data, params):
+        """
+        Samples the infection parameters and sets the initial infection state
+        of the agents.
+        """
+        device = params["system"]["device"]
+        stage_dtype = get_dtype(params["system"].get("stage_dtype", "int64"))
+        state_dtype = get_dtype(params["system"].get("state_dtype", "float32"))
         n_agents = len(data["agent"]["id"])
-        inf_params = {}
+        # the agent state of an ensemble has a leading member dimension
+        ensemble_size = params["system"].get("ensemble_size")
+        if ensemble_size is None:
+            state_shape = (n_agents,)
+        else:
+            state_shape = (ensemble_size, n_agents)
         transmission_sampler = TransmissionSampler.from_parameters(params)
-        transmission_values = transmission_sampler(n_agents)
-        inf_params["max_infectiousness"] = transmission_values[0, :]
-        inf_params["shape"] = transmission_values[1, :]
-        inf_params["rate"] = transmission_values[2, :]
-        inf_params["shift"] = transmission_values[3, :]
+        if params["system"].get("lazy_infection_parameters", False):
+            # drawn per agent the first time it is infected
+            inf_params = LazyInfectionParameters(
+                transmission_sampler,
+                state_shape,
+                seed=int(torch.randint(2**31 - 1, ())),
+                device=device,
+            )
+            if not params["system"].get("inference", False):
+                # the differentiable path needs the parameters of every agent
+                warnings.warn(
+                    "Lazy infection parameters are only used in inference runs, "
+                    "drawing them for all the agents."
+                )
+                inf_params = dict(inf_params.items())
+        else:
+            inf_params = {}
+            transmission_values = transmission_sampler(state_shape)
+            inf_params["max_infectiousness"] = transmission_values[0]
+            inf_params["shape"] = transmission_values[1]
+            inf_params["rate"] = transmission_values[2]
+            inf_params["shift"] = transmission_values[3]
         data["agent"].infection_parameters = inf_params
-        data["agent"].transmission = torch.zeros(n_agents, device=device)
-        data["agent"].susceptibility = torch.ones(n_agents, device=device)
-        data["agent"].is_infected = torch.zeros(n_agents, device=device)
-        data["agent"].infection_time = torch.zeros(n_agents, device=device)
+        data["agent"].transmission = torch.zeros(state_shape, device=device)
+        data["agent"].susceptibility = torch.ones(
+            state_shape, dtype=state_dtype, device=device
+        )
+        data["agent"].is_infected = torch.zeros(
+            state_shape, dtype=state_dtype, device=device
+        )
+        data["agent"].infection_time = torch.zeros(state_shape, device=device)
         symptoms = {}
         symptoms["current_stage"] = torch.ones(
-            n_agents, dtype=torch.long, device=device
+            state_shape, dtype=stage_dtype, device=device
         )
-        symptoms["next_stage"] = torch.ones(n_agents, dtype=torch.long, device=device)
-        symptoms["time_to_next_stage"] = torch.zeros(n_agents, device=device)
+        symptoms["next_stage"] = torch.ones(
+            state_shape, dtype=stage_dtype, device=device
+        )
+        symptoms["time_to_next_stage"] = torch.zeros(state_shape, device=device)
         data["agent"].symptoms = symptoms
         return data
 
     def backup_infection_data(self, data):
-        ret = {}
-        ret["susceptibility"] = data["agent"].susceptibility.detach().clone()
-        ret["is_infected"] = data["agent"].is_infected.detach().clone()
-        ret["infection_time"] = data["agent"].infection_time.detach().clone()
-        ret["transmission"] = data["agent"].transmission.detach().clone()
-        symptoms = {}
-        symptoms["current_stage"] = (
-            data["agent"]["symptoms"]["current_stage"].detach().clone()
-        )
-        symptoms["next_stage"] = (
-            data["agent"]["symptoms"]["next_stage"].detach().clone()
-        )
-        symptoms["time_to_next_stage"] = (
-            data["agent"]["symptoms"]["time_to_next_stage"].detach().clone()
-        )
-        ret["symptoms"] = symptoms
+        """
+        Returns a snapshot of the initial agent state. If the model runs on
+        a GPU, the snapshot is kept in pinned host memory. It also allocates
+        the state arena, the buffers that hold the agent state at the start of
+        every run.
+        """
+        ret = {"symptoms": {}}
+        self._arena = {"symptoms": {}}
+        self._arena_versions = {}
+        pin = torch.device(self.device).type == "cuda"
+        for key in self._get_state_keys():
+            value = self._get_in(data["agent"], key).detach()
+            snapshot = value.clone()
+            if pin:
+                snapshot = snapshot.cpu().pin_memory()
+            self._set_in(ret, key, snapshot)
+            buffer = value.clone()
+            self._set_in(self._arena, key, buffer)
+            self._arena_versions[key] = buffer._version
         return ret
 
+    def _get_state_keys(self):
+        return list(self.state_keys) + [
+            ("symptoms", key) for key in self.symptoms_keys
+        ]
+
+    @staticmethod
+    def _get_in(container, key):
+        if isinstance(key, tuple):
+            return container[key[0]][key[1]]
+        return container[key]
+
+    @staticmethod
+    def _set_in(container, key, value):
+        if isinstance(key, tuple):
+            container[key[0]][key[1]] = value
+        else:
+            container[key] = value
+
     def restore_initial_data(self):
-        self.data["agent"].transmission = (
-            self.data_backup["transmission"].detach().clone()
-        )
-        self.data["agent"].susceptibility = (
-            self.data_backup["susceptibility"].detach().clone()
-        )
-        self.data["agent"].is_infected = (
-            self.data_backup["is_infected"].detach().clone()
-        )
-        self.data["agent"].infection_time = (
-            self.data_backup["infection_time"].detach().clone()
-        )
-        self.data["agent"].symptoms["current_stage"] = (
-            self.data_backup["symptoms"]["current_stage"].detach().clone()
-        )
-        self.data["agent"].symptoms["next_stage"] = (
-            self.data_backup["symptoms"]["next_stage"].detach().clone()
-        )
-        self.data["agent"].symptoms["time_to_next_stage"] = (
-            self.data_backup["symptoms"]["time_to_next_stage"].detach().clone()
-        )
+        """
+        Resets the agent state to the initial snapshot. The state is restored
+        into the preallocated arena buffers with in place copies, and buffers
+        that have not been modified in place since the last restore (the
+        differentiable path never does) are not copied at all.
+        Note that restoring a buffer modified in place invalidates the graph
+        of the previous run, so backward must be called before the next run.
+        """
+        for key in self._get_state_keys():
+            buffer = self._get_in(self._arena, key)
+            if buffer._version != self._arena_versions[key]:
+                buffer.copy_(self._get_in(self.data_backup, key), non_blocking=True)
+                self._arena_versions[key] = buffer._version
+            self._set_in(self.data["agent"], key, buffer)
         # reset results
         self.data["results"] = {}
         self.data["results"]["deaths_per_timestep"] = None
 
     def set_initial_cases(self):
         fraction_initial_cases = 10.0**self.log_fraction_initial_cases
+        if self.inference:
+            probs = fraction_initial_cases * torch.ones(
+                self.data["agent"].susceptibility.shape, device=self.device
+            )
+            new_infected = self.model.is_infected_sampler.sample(1.0 - probs)
+            infect_people_(self.data, self.timer, new_infected)
+            self.model.symptoms_updater.update_(
+                data=self.data, timer=self.timer, new_infected=new_infected
+            )
+            return
         new_infected = infect_fraction_of_people(
             data=self.data,
             timer=self.timer,
@@ -148,39 +270,348 @@ class Runner(torch.nn.Module):
             data=self.data, timer=self.timer, new_infected=new_infected
         )
 
-    def forward(self):
+    def forward(self, resume_from=None):
+        """
+        Runs the model from the initial date to the final date. In inference
+        mode the run is not differentiable, and it uses the faster sampling
+        and in place updates of GradJune.inference_step.
+
+        Parameters
+        ----------
+        resume_from:
+            path to a run state saved with `save_state`. The run continues
+            from that time step instead of starting from the initial date.
+        """
+        with torch.inference_mode(self.inference):
+            return self._run(resume_from=resume_from)
+
+    def _run(self, resume_from=None, fork_step=None, seed=None):
+        """
+        Runs the model. If `fork_step` is given, the run stops after that many
+        time steps and returns its state instead of the results. `seed` seeds
+        the random number generator after resuming.
+        """
         timer = self.timer
         model = self.model
         data = self.data
-        timer.reset()
-        self.restore_initial_data()
-        self.set_initial_cases()
-        cases_per_timestep = data["agent"].is_infected.sum()
-        cases_by_age = self.get_cases_by_age(data)
-        self.store_differentiable_deaths(data)
-        dates = [timer.date]
-        i = 0
-        while timer.date < timer.final_date:
-            i += 1
-            next(timer)
-            data = model(data, timer)
-            cases = data["agent"].is_infected.sum()
-            cases_per_timestep = torch.hstack((cases_per_timestep, cases))
-            self.store_differentiable_deaths(data)
-            cases_age = self.get_cases_by_age(data)
-            cases_by_age = torch.vstack((cases_by_age, cases_age))
-            dates.append(timer.date)
+        # one slot per time step, stacked once at the end of the run so that
+        # each step adds a single node to the graph instead of a concatenation
+        n_steps = timer.get_total_timesteps()
+        last_step = n_steps if fork_step is None else fork_step
+        records = [None] * (n_steps + 1)
+        dates = [None] * (n_steps + 1)
+        if resume_from is None:
+            timer.reset()
+            self.restore_initial_data()
+            self.set_initial_cases()
+            records[0] = self._record_step(data)
+            dates[0] = timer.date
+            first_step = 0
+        elif isinstance(resume_from, dict):
+            first_step = self.set_run_state(resume_from, records, dates)
+        else:
+            first_step = self.load_state(resume_from, records, dates)
+        if seed is not None:
+            torch.manual_seed(seed)
+        if self.inference or self.checkpoint_window is None:
+            step = model.inference_step if self.inference else model
+            for i in range(first_step + 1, last_step + 1):
+                next(timer)
+                data = step(data, timer)
+                records[i] = self._record_step(data)
+                dates[i] = timer.date
+                if self._is_save_step(i - 1, i):
+                    self.save_state(self.state_path, i, records, dates)
+        else:
+            state = self._get_state(data)
+            for start in range(first_step, last_step, self.checkpoint_window):
+                n_window_steps = min(self.checkpoint_window, last_step - start)
+                # the window is recomputed in the backward pass from its
+                # initial state, timer and random state
+                state, window_records = checkpoint(
+                    self._run_window,
+                    copy.copy(timer),
+                    n_window_steps,
+                    *state,
+                    use_reentrant=False,
+                    preserve_rng_state=True,
+                )
+                for i in range(start + 1, start + n_window_steps + 1):
+                    next(timer)
+                    records[i] = window_records[i - start - 1]
+                    dates[i] = timer.date
+                if self._is_save_step(start, start + n_window_steps):
+                    self._set_state(data, state)
+                    self.save_state(
+                        self.state_path, start + n_window_steps, records, dates
+                    )
+            self._set_state(data, state)
+        if fork_step is not None:
+            return self.get_run_state(fork_step, records, dates)
+        cases_per_timestep = torch.stack([record[0] for record in records])
+        data["results"]["deaths_per_timestep"] = torch.stack(
+            [record[1] for record in records]
+        )
+        breakdowns = [record[2] for record in records]
+        stage_breakdowns = [record[3] for record in records]
         results = {
             "dates": dates,
             "cases_per_timestep": cases_per_timestep,
             "daily_cases_per_timestep": torch.diff(
-                cases_per_timestep, prepend=torch.tensor([0.0], device=self.device)
+                cases_per_timestep,
+                dim=0,
+                prepend=torch.zeros_like(cases_per_timestep[:1]),
             ),
             "deaths_per_timestep": data.results["deaths_per_timestep"],
         }
-        for (i, key) in enumerate(self.age_bins[1:]):
-            results[f"cases_by_age_{key:02d}"] = cases_by_age[:, i]
-        return results, data["agent"].is_infected
+        results.update(self._get_breakdown_results(breakdowns, stage_breakdowns))
+        is_infected = data["agent"].is_infected
+        if is_infected is self._arena.get("is_infected"):
+            # the next run overwrites the arena
+            is_infected = is_infected.clone()
+        return results, is_infected
+
+    def _record_step(self, data):
+        """
+        Returns the outputs of a time step: total cases and deaths, their
+        breakdowns by category and the symptom stage counts if aggregated.
+        """
+        cases = data["agent"].is_infected.float()
+        deaths = self.get_agent_deaths(data)
+        # cases and deaths by every category in a single pass
+        breakdowns = self.aggregator.aggregate(torch.stack((cases, deaths)))
+        stage_breakdowns = None
+        if self.aggregate_stages:
+            stage_breakdowns = self.aggregator.aggregate_stages(
+                data["agent"].symptoms["current_stage"],
+                len(self.model.symptoms_updater.stages_ids),
+            )
+        return cases.sum(-1), deaths.sum(-1), breakdowns, stage_breakdowns
+
+    def _get_state(self, data):
+        agent = data["agent"]
+        return tuple(agent[key] for key in self.state_keys) + tuple(
+            agent.symptoms[key] for key in self.symptoms_keys
+        )
+
+    def _set_state(self, data, state):
+        n_keys = len(self.state_keys)
+        for key, value in zip(self.state_keys, state[:n_keys]):
+            data["agent"][key] = value
+        for key, value in zip(self.symptoms_keys, state[n_keys:]):
+            data["agent"].symptoms[key] = value
+
+    def _run_window(self, timer, n_steps, *state):
+        """
+        Runs n_steps time steps from the given agent state. It works on a
+        shallow copy of the graph, so that recomputing the window in the
+        backward pass does not touch the state of the run.
+        """
+        data = copy.copy(self.data)
+        data["agent"].symptoms = dict(data["agent"].symptoms)
+        self._set_state(data, state)
+        timer = copy.copy(timer)
+        records = []
+        for _ in range(n_steps):
+            next(timer)
+            data = self.model(data, timer)
+            records.append(self._record_step(data))
+        return self._get_state(data), records
+
+    def run_scenarios(self, fork_date, scenario_policies, seeds=None):
+        """
+        Runs the model up to `fork_date` once, and then continues the run
+        from that state with each of the given policies. The state at the fork
+        date is shared by all the scenarios, which only copy the agent state
+        into the state arena when they start, so the shared part of the run
+        is computed once. Scenarios are not differentiable with respect to
+        the shared part of the run.
+
+        Parameters
+        ----------
+        fork_date:
+            date (datetime or "YYYY-MM-DD") where the scenarios branch off.
+        scenario_policies:
+            list of Policies, one per scenario.
+        seeds:
+            random seed of each scenario. By default they are drawn from the
+            random number generator after the shared part of the run.
+
+        Returns
+        -------
+        list with the results and is_infected of each scenario.
+        """
+        if isinstance(fork_date, str):
+            fork_date = datetime.datetime(
+                *[int(value) for value in fork_date.split("-")]
+            )
+        timer = copy.copy(self.timer)
+        timer.reset()
+        fork_step = 0
+        while timer.date < fork_date:
+            next(timer)
+            fork_step += 1
+        if fork_step > timer.get_total_timesteps():
+            raise ValueError(f"Fork date {fork_date} is after the final date.")
+        default_policies = self.model.policies
+        ret = []
+        with torch.inference_mode(self.inference):
+            fork_state = self._run(fork_step=fork_step)
+            if seeds is None:
+                seeds = torch.randint(2**62, (len(scenario_policies),)).tolist()
+            try:
+                for policies, seed in zip(scenario_policies, seeds):
+                    self.model.policies = policies
+                    ret.append(self._run(resume_from=fork_state, seed=seed))
+            finally:
+                self.model.policies = default_policies
+        return ret
+
+    def _is_save_step(self, previous_step, step):
+        """
+        Whether a multiple of `save_state_every` was crossed when advancing
+        from previous_step to step.
+        """
+        if self.state_path is None or self.save_state_every is None:
+            return False
+        every = self.save_state_every
+        return step // every > previous_step // every
+
+    def save_state(self, path, step, records, dates):
+        """
+        Saves the state of a run after `step` time steps: the agent state and
+        infection parameters, the timer position, the quarantine masks, the
+        random number generator states and the outputs recorded so far. The
+        file is written with torch.save and then moved into place, so an
+        interrupted save never corrupts the previous state.
+        Tensors are saved detached, so a resumed run is only differentiable
+        with respect to the steps after the resume point.
+        """
+        path = Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        torch.save(self.get_run_state(step, records, dates), tmp_path)
+        os.replace(tmp_path, path)
+
+    def get_run_state(self, step, records, dates):
+        """
+        Returns the state of a run after `step` time steps, see `save_state`.
+        Tensors are detached and shared with the run, except for the state
+        arena buffers, which are cloned since they are updated in place.
+        """
+        agent = self.data["agent"]
+        quarantine_policies = self.model.policies.quarantine_policies
+        quarantine_mask = None
+        if quarantine_policies is not None:
+            quarantine_mask = quarantine_policies.quarantine_mask
+        agent_state = {"symptoms": {}}
+        for key in self._get_state_keys():
+            value = self._get_in(agent, key)
+            if value is self._get_in(self._arena, key):
+                value = value.clone()
+            self._set_in(agent_state, key, value.detach())
+        return {
+            "step": step,
+            "n_steps": len(records) - 1,
+            "agent": agent_state,
+            "infection_parameters": self._get_infection_parameters_state(
+                agent.infection_parameters
+            ),
+            "timer": self.timer.get_position(),
+            "quarantine_mask": _detach(quarantine_mask),
+            "rng_state": torch.get_rng_state(),
+            "cuda_rng_state": (
+                torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+            ),
+            "records": _detach(records[: step + 1]),
+            "dates": dates[: step + 1],
+        }
+
+    def load_state(self, path, records, dates):
+        """
+        Loads a run state saved with `save_state`. The file is memory mapped
+        and the agent state is copied into the state arena, so only the pages
+        that are read are loaded from disk. The recorded outputs are written
+        into `records` and `dates`.
+
+        Returns
+        -------
+        the time step the run resumes from.
+        """
+        state = torch.load(path, mmap=True, weights_only=False)
+        return self.set_run_state(state, records, dates)
+
+    @staticmethod
+    def _get_infection_parameters_state(infection_parameters):
+        if isinstance(infection_parameters, LazyInfectionParameters):
+            # the values only depend on the seed, the drawn ones are a cache
+            # that the runs sharing the state can keep extending
+            return infection_parameters
+        return {key: value.detach() for key, value in infection_parameters.items()}
+
+    def set_run_state(self, state, records, dates):
+        """
+        Sets a run state returned by `get_run_state`. The agent state is
+        copied into the state arena and the rest of tensors are shared.
+
+        Returns
+        -------
+        the time step the run resumes from.
+        """
+        if state["n_steps"] != len(records) - 1:
+            raise ValueError(
+                f"State saved for a run of {state['n_steps']} time steps, "
+                f"but this run has {len(records) - 1}."
+            )
+        self.restore_initial_data()
+        agent = self.data["agent"]
+        with torch.no_grad():
+            for key in self._get_state_keys():
+                self._get_in(agent, key).copy_(self._get_in(state["agent"], key))
+        infection_parameters = state["infection_parameters"]
+        if isinstance(infection_parameters, dict):
+            infection_parameters = {
+                key: value.to(self.device)
+                for key, value in infection_parameters.items()
+            }
+        agent.infection_parameters = infection_parameters
+        self.timer.set_position(state["timer"])
+        quarantine_policies = self.model.policies.quarantine_policies
+        if quarantine_policies is not None and state["quarantine_mask"] is not None:
+            quarantine_policies.quarantine_mask = state["quarantine_mask"]
+        torch.set_rng_state(state["rng_state"])
+        if state["cuda_rng_state"] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["cuda_rng_state"])
+        step = state["step"]
+        records[: step + 1] = _to_device(state["records"], self.device)
+        dates[: step + 1] = state["dates"]
+        return step
+
+    def _get_breakdown_results(self, breakdowns, stage_breakdowns):
+        """
+        Returns the time series of cases and deaths for every category of the
+        aggregated attributes, and of the symptom stages if they are aggregated.
+        Cases by age are always returned.
+        """
+        ret = {}
+        stages = self.model.symptoms_updater.symptoms_sampler.stages
+        for attribute in self.aggregator.attributes:
+            by_attribute = torch.stack([step[attribute] for step in breakdowns])
+            labels = self.aggregator.labels[attribute]
+            for j, label in enumerate(labels):
+                label = f"{label:02d}" if attribute == "age" else label
+                ret[f"cases_by_{attribute}_{label}"] = by_attribute[:, 0, ..., j]
+                if attribute in self.aggregate_by:
+                    ret[f"deaths_by_{attribute}_{label}"] = by_attribute[
+                        :, 1, ..., j
+                    ]
+            if not self.aggregate_stages or attribute not in self.aggregate_by:
+                continue
+            by_stage = torch.stack([step[attribute] for step in stage_breakdowns])
+            for k, stage in enumerate(stages):
+                for j, label in enumerate(labels):
+                    ret[f"{stage}_by_{attribute}_{label}"] = by_stage[..., k, j]
+        return ret
 
     def save_results(self, results, is_infected):
         self.save_path.mkdir(exist_ok=True, parents=True)
@@ -189,54 +620,81 @@ class Runner(torch.nn.Module):
         for key in results:
             if key in ("dates"):
                 continue
-            df[key] = results[key].detach().cpu().numpy()
+            values = results[key].detach().cpu().numpy()
+            if values.ndim == 1:
+                df[key] = values
+                continue
+            # ensemble runs, one column per member
+            for member in range(values.shape[1]):
+                df[f"{key}_{member}"] = values[:, member]
         df.to_csv(self.save_path / "results.csv")
         df = pd.DataFrame()
-        df["is_infected"] = is_infected
+        is_infected = is_infected.detach().cpu().numpy()
+        if is_infected.ndim == 1:
+            df["is_infected"] = is_infected
+        else:
+            for member in range(is_infected.shape[0]):
+                df[f"is_infected_{member}"] = is_infected[member]
         df.to_csv(self.save_path / "results_is_infected.csv")
 
-    def store_differentiable_deaths(self, data):
+    def get_agent_deaths(self, data):
         """
-        Returns differentiable deaths. The results are stored
-        in data["results"]
+        Returns a differentiable mask that is 1 for dead agents and 0 otherwise.
         """
         symptoms = data["agent"].symptoms
         dead_idx = self.model.symptoms_updater.stages_ids[-1]
-        deaths = (
+        return (
             (symptoms["current_stage"] == dead_idx)
             * symptoms["current_stage"]
             / dead_idx
         )
-        if data["results"]["deaths_per_timestep"] is not None:
-            data["results"]["deaths_per_timestep"] = torch.hstack(
-                (data["results"]["deaths_per_timestep"], deaths.sum())
-            )
-        else:
-            data["results"]["deaths_per_timestep"] = deaths.sum()
+
+    def get_differentiable_deaths(self, data):
+        """
+        Returns the differentiable number of dead agents.
+        """
+        return self.get_agent_deaths(data).sum(-1)
 
     def get_cases_by_age(self, data):
-        ret = torch.zeros(self.age_bins.shape[0] - 1, device=self.device)
-        for i in range(1, self.age_bins.shape[0]):
-            mask1 = data["agent"].age < self.age_bins[i]
-            mask2 = data["agent"].age > self.age_bins[i - 1]
-            mask = mask1 * mask2
-            ret[i - 1] = (data["agent"].is_infected * mask).sum()
-        return ret
+        return self.aggregator.aggregate(data["agent"].is_infected)["age"]
 
     def get_people_by_age(self):
-        ret = {}
-        for i in range(1, self.age_bins.shape[0]):
-            mask1 = self.data["agent"].age < self.age_bins[i]
-            mask2 = self.data["agent"].age > self.age_bins[i - 1]
-            mask = mask1 * mask2
-            ret[int(self.age_bins[i].item())] = mask.sum()
-        return ret
+        people = self.aggregator.aggregate(
+            torch.ones(self.n_agents, device=self.device)
+        )["age"]
+        return {
+            label: people[i]
+            for i, label in enumerate(self.aggregator.labels["age"])
+        }
 
     def get_cases_by_ethnicity(self, data):
-        ret = torch.zeros(len(self.ethnicities), device=self.device)
-        for i, ethnicity in enumerate(self.ethnicities):
-            mask = torch.tensor(
-                self.data["agent"].ethnicity == ethnicity, device=self.device
-            )
-            ret[i] = (mask * data["agent"].is_infected).sum()
-        return ret
+        aggregator = self.aggregator
+        if "ethnicity" not in aggregator.attributes:
+            # the runner aggregator is left as is, so the outputs of the runs
+            # do not change
+            if self._ethnicity_aggregator is None:
+                self._ethnicity_aggregator = Aggregator(
+                    self.data, attributes=("ethnicity",), device=self.device
+                )
+            aggregator = self._ethnicity_aggregator
+        return aggregator.aggregate(data["agent"].is_infected)["ethnicity"]
+
+
+def _detach(value):
+    if torch.is_tensor(value):
+        return value.detach()
+    if isinstance(value, dict):
+        return {key: _detach(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_detach(item) for item in value)
+    return value
+
+
+def _to_device(value, device):
+    if torch.is_tensor(value):
+        return value.to(device)
+    if isinstance(value, dict):
+        return {key: _to_device(item, device) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_device(item, device) for item in value)
+    return value
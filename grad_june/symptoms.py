@@ -1,5 +1,6 @@
 from operator import ne
 import torch
+import torch.distributions as dist
 import yaml
 
 from grad_june.utils import parse_age_probabilities, parse_distribution
@@ -7,6 +8,77 @@ from grad_june.default_parameters import make_parameters
 from grad_june.paths import default_config_path
 
 
+class CalendarQueue:
+    """
+    Calendar queue of the pending symptom stage transitions. The agents whose
+    next stage differs from their current one are bucketed by the time of
+    their next transition, in buckets of `bucket_width` days, so that a time
+    step only looks at the agents in the buckets up to the current time.
+    Agents are stored by their index in the flattened agent state, so that
+    ensemble members are queued independently.
+    """
+
+    _keys = ("current_stage", "next_stage", "time_to_next_stage")
+
+    def __init__(self, bucket_width=1.0):
+        self.bucket_width = bucket_width
+        self.buckets = {}
+        self._synced = None
+
+    def _get_buckets(self, times):
+        return torch.floor(times / self.bucket_width).long()
+
+    def push(self, agents, times):
+        """
+        Queues the agents to transition at the given times.
+        """
+        if len(agents) == 0:
+            return
+        buckets = self._get_buckets(times)
+        keys, counts = torch.unique(buckets, return_counts=True)
+        agents = agents[torch.argsort(buckets)]
+        for key, group in zip(keys.tolist(), agents.split(counts.tolist())):
+            self.buckets.setdefault(key, []).append(group)
+
+    def pop(self, time, times):
+        """
+        Removes and returns the agents due to transition at `time`, given the
+        flattened times of the next transition of every agent.
+        """
+        current_bucket = int(time // self.bucket_width)
+        keys = [key for key in self.buckets if key <= current_bucket]
+        if not keys:
+            return torch.zeros(0, dtype=torch.long, device=times.device)
+        agents = torch.cat([group for key in keys for group in self.buckets.pop(key)])
+        is_due = times[agents] <= time
+        not_due = agents[~is_due]
+        if len(not_due) > 0:
+            self.buckets.setdefault(current_bucket, []).append(not_due)
+        return agents[is_due]
+
+    def sync(self, symptoms):
+        """
+        Rebuilds the queue from the symptoms if they were changed since the
+        queue was last updated, e.g. when the initial state is restored.
+        """
+        tensors = [symptoms[key] for key in self._keys]
+        if self._synced is not None and all(
+            tensor is synced and tensor._version == version
+            for tensor, (synced, version) in zip(tensors, self._synced)
+        ):
+            return
+        self.buckets = {}
+        current_stage, next_stage, time_to_next_stage = (
+            tensor.reshape(-1) for tensor in tensors
+        )
+        agents = torch.nonzero(current_stage != next_stage).squeeze(-1)
+        self.push(agents, time_to_next_stage[agents])
+        self.mark_synced(symptoms)
+
+    def mark_synced(self, symptoms):
+        self._synced = [(symptoms[key], symptoms[key]._version) for key in self._keys]
+
+
 class SymptomsSampler:
     def __init__(
         self,
@@ -15,9 +87,12 @@ class SymptomsSampler:
         stage_transition_times,
         recovery_times,
         device,
+        calendar_queue=False,
     ):
         self.stages = stages
         self.stages_ids = torch.arange(0, len(stages))
+        # the in place updates only process the agents due to transition
+        self.calendar_queue = CalendarQueue() if calendar_queue else None
 
         self.stage_transition_probabilities = (
             self._parse_stage_transition_probabilities(
@@ -28,6 +103,7 @@ class SymptomsSampler:
             stage_transition_times, device=device
         )
         self.recovery_times = self._parse_stage_times(recovery_times, device=device)
+        self.stage_times_table = self._stack_stage_times(device=device)
 
     @classmethod
     def from_file(cls, fpath=default_config_path):
@@ -37,7 +113,11 @@ class SymptomsSampler:
 
     @classmethod
     def from_parameters(cls, params):
-        return cls(**params["symptoms"], device=params["system"]["device"])
+        return cls(
+            **params["symptoms"],
+            device=params["system"]["device"],
+            calendar_queue=params["system"].get("symptoms_calendar_queue", False),
+        )
 
     def _parse_stage_transition_probabilities(
         self, stage_transition_probabilities, device
@@ -62,6 +142,56 @@ class SymptomsSampler:
                 ret[i] = parse_distribution(stage_times[stage], device)
         return ret
 
+    def _stack_stage_times(self, device):
+        """
+        Stacks the location and scale of the stage transition (row 0) and
+        recovery (row 1) time distributions of every stage, so that the times
+        of all the agents are drawn at once. Returns None if any distribution
+        is not Normal or LogNormal.
+        """
+        loc = torch.zeros((2, len(self.stages)), device=device)
+        scale = torch.zeros((2, len(self.stages)), device=device)
+        is_log = torch.zeros((2, len(self.stages)), dtype=torch.bool, device=device)
+        for row, stage_times in enumerate(
+            (self.stage_transition_times, self.recovery_times)
+        ):
+            for i, distribution in stage_times.items():
+                if distribution is None:
+                    continue
+                if isinstance(distribution, dist.LogNormal):
+                    is_log[row, i] = True
+                elif not isinstance(distribution, dist.Normal):
+                    return None
+                loc[row, i] = distribution.loc
+                scale[row, i] = distribution.scale
+        return {"loc": loc, "scale": scale, "is_log": is_log}
+
+    def _sample_stage_times(self, stages, recovers):
+        """
+        Samples the time to the next stage of agents at the given stages,
+        from the recovery time distribution where `recovers` is True and from
+        the stage transition time distribution otherwise. The draws are
+        reparameterized, and agents at stages without a distribution get 0.
+        """
+        stages = stages.long()
+        rows = recovers.long()
+        if self.stage_times_table is not None:
+            table = self.stage_times_table
+            times = table["loc"][rows, stages] + table["scale"][
+                rows, stages
+            ] * torch.randn(stages.shape, device=stages.device)
+            return torch.where(table["is_log"][rows, stages], torch.exp(times), times)
+        times = torch.zeros(stages.shape, device=stages.device)
+        for i in range(2, len(self.stages) - 1):
+            for row, stage_times in enumerate(
+                (self.stage_transition_times, self.recovery_times)
+            ):
+                mask = (stages == i) & (rows == row)
+                n_agents = int(mask.sum())
+                if n_agents > 0:
+                    times[mask] = stage_times[i].rsample((n_agents,))
+        return times
+
     def _get_need_to_transition(self, current_stage, time_to_next_stage, time):
         """
         Gets a mask that is 1 for the agents that need to transition stage and 0
@@ -90,41 +220,100 @@ class SymptomsSampler:
         mask_transition = self._get_need_to_transition(
             current_stage, time_to_next_stage, time
         )
-        n_agents = ages.shape[0]
         current_stage = current_stage - (current_stage - next_stage) * mask_transition
         # Sample possible next stages
         probs = self._get_prob_next_symptoms_stage(ages, current_stage.long())
         mask_symp_stage = torch.bernoulli(probs).to(torch.bool) # no dependence on parameters here.
         # These ones would recover
         mask_recovered_stage = ~mask_symp_stage
-        for i in range(
-            2, len(self.stages) - 1
-        ):  # skip recovered, susceptible, and dead
-            # Check people at this stage that need updating
-            mask_stage = (current_stage == i)
-            # this makes sure the gradient flows, since we lost it in the previous line.
-            mask_stage = mask_stage * current_stage / i 
-            mask_updating = mask_stage * mask_transition
-
-            # These people progress to another disease stage
-            mask_symp = mask_updating * mask_symp_stage
-            n_symp = mask_symp.max()  # faster than sum
-            if n_symp > 0:
-                next_stage = next_stage + mask_symp
-                time_to_next_stage = (
-                    time_to_next_stage
-                    + self.stage_transition_times[i].rsample((n_agents,)) * mask_symp
-                )
-
-            # These people will recover
-            mask_rec = mask_updating * mask_recovered_stage
-            n_rec = mask_rec.max()
-            if n_rec > 0:
-                next_stage = next_stage - next_stage * mask_rec  # Set to 0
-                time_to_next_stage = (
-                    time_to_next_stage
-                    + self.recovery_times[i].rsample((n_agents,)) * mask_rec
-                )
+        # Check people that need updating, skipping recovered, susceptible, and dead
+        mask_stage = (current_stage >= 2) & (current_stage < len(self.stages) - 1)
+        # this makes sure the gradient flows, since we lost it in the previous line.
+        mask_stage = mask_stage * current_stage / current_stage.detach().clamp(min=1)
+        mask_updating = mask_stage * mask_transition
+        # These people progress to another disease stage
+        mask_symp = mask_updating * mask_symp_stage
+        # These people will recover
+        mask_rec = mask_updating * mask_recovered_stage
+        next_stage = next_stage + mask_symp
+        next_stage = next_stage - next_stage * mask_rec  # Set to 0
+        # only the agents that transition draw a stage time, from the
+        # distribution of their stage and outcome. The times are scattered
+        # back out of place so the gradient through mask_updating is kept.
+        idx = (mask_updating != 0).nonzero(as_tuple=True)
+        stage_times = self._sample_stage_times(
+            current_stage[idx], mask_recovered_stage[idx]
+        )
+        time_to_next_stage = time_to_next_stage.index_put(
+            idx, time_to_next_stage[idx] + stage_times * mask_updating[idx]
+        )
+        return current_stage, next_stage, time_to_next_stage
+
+    def sample_next_stage_(
+        self, ages, current_stage, next_stage, time_to_next_stage, time
+    ):
+        """
+        In place version of sample_next_stage for runs that are not
+        differentiated. It uses boolean masks and only samples the stage times
+        of the agents that transition.
+        """
+        if self.calendar_queue is not None:
+            return self._sample_queued_next_stage_(
+                ages, current_stage, next_stage, time_to_next_stage, time
+            )
+        mask_transition = (time >= time_to_next_stage) & (
+            current_stage < len(self.stages) - 1
+        )
+        torch.where(
+            mask_transition,
+            next_stage.to(current_stage.dtype),
+            current_stage,
+            out=current_stage,
+        )
+        probs = self._get_prob_next_symptoms_stage(ages, current_stage.long())
+        mask_symp_stage = torch.bernoulli(probs).to(torch.bool)
+        mask_updating = (
+            (current_stage >= 2)
+            & (current_stage < len(self.stages) - 1)
+            & mask_transition
+        )
+        next_stage.add_(mask_updating & mask_symp_stage)
+        next_stage.masked_fill_(mask_updating & ~mask_symp_stage, 0)
+        # only the agents that transition draw a stage time
+        time_to_next_stage[mask_updating] += self._sample_stage_times(
+            current_stage[mask_updating], ~mask_symp_stage[mask_updating]
+        )
+        return current_stage, next_stage, time_to_next_stage
+
+    def _sample_queued_next_stage_(
+        self, ages, current_stage, next_stage, time_to_next_stage, time
+    ):
+        """
+        Same update as sample_next_stage_, but it only processes the agents
+        popped from the calendar queue. Agents that keep progressing through
+        the disease are queued again at the time of their next transition.
+        """
+        current = current_stage.view(-1)
+        next_ = next_stage.view(-1)
+        times = time_to_next_stage.view(-1)
+        agents = self.calendar_queue.pop(time, times)
+        if len(agents) > 0:
+            stages = next_[agents]
+            current[agents] = stages.to(current.dtype)
+            probs = self._get_prob_next_symptoms_stage(
+                ages[agents % ages.shape[-1]], stages.long()
+            )
+            mask_symp_stage = torch.bernoulli(probs).to(torch.bool)
+            mask_updating = (stages >= 2) & (stages < len(self.stages) - 1)
+            progressing = agents[mask_updating]
+            recovers = ~mask_symp_stage[mask_updating]
+            next_[progressing] = torch.where(
+                recovers, 0, next_[progressing] + 1
+            ).to(next_.dtype)
+            times[progressing] += self._sample_stage_times(
+                stages[mask_updating], recovers
+            )
+            self.calendar_queue.push(progressing, times[progressing])
         return current_stage, next_stage, time_to_next_stage
 
 
@@ -246,6 +435,31 @@ class SymptomsUpdater(torch.nn.Module):
         symptoms["time_to_next_stage"] = time_to_next_stage
         return symptoms
 
+    def update_(self, data, timer, new_infected):
+        """
+        In place symptoms update for runs that are not differentiated, with
+        `new_infected` a boolean mask.
+        """
+        symptoms = data["agent"].symptoms
+        queue = self.symptoms_sampler.calendar_queue
+        if queue is not None:
+            queue.sync(symptoms)
+        symptoms["next_stage"].masked_fill_(new_infected, 2)
+        symptoms["time_to_next_stage"].masked_fill_(new_infected, timer.now)
+        if queue is not None:
+            new_agents = torch.nonzero(new_infected.reshape(-1)).squeeze(-1)
+            queue.push(new_agents, symptoms["time_to_next_stage"].view(-1)[new_agents])
+        self.symptoms_sampler.sample_next_stage_(
+            ages=data["agent"].age,
+            current_stage=symptoms["current_stage"],
+            next_stage=symptoms["next_stage"],
+            time_to_next_stage=symptoms["time_to_next_stage"],
+            time=timer.now,
+        )
+        if queue is not None:
+            queue.mark_synced(symptoms)
+        return symptoms
+
     @property
     def stages_ids(self):
         """
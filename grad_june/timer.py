@@ -4,6 +4,7 @@ Taken from JUNE.
 
 import calendar
 import datetime
+from copy import copy
 import yaml
 from typing import List
 
@@ -136,6 +137,39 @@ class Timer:
         self.n_timesteps += 1
         return self.date
 
+    def get_position(self):
+        """
+        Returns the current position of the timer, which can be restored
+        with `set_position`.
+        """
+        return {
+            "date": self.date,
+            "previous_date": self.previous_date,
+            "shift": self.shift,
+            "n_timesteps": self.n_timesteps,
+        }
+
+    def set_position(self, position):
+        self.date = position["date"]
+        self.previous_date = position["previous_date"]
+        self.shift = position["shift"]
+        self.n_timesteps = position["n_timesteps"]
+        self.delta_time = datetime.timedelta(hours=self.shift_duration)
+
+    def get_total_timesteps(self):
+        """
+        Returns the number of time steps from the initial to the final date,
+        that is, how many times the timer advances in a full run. The count is
+        done on a copy, so the state of this timer is not changed.
+        """
+        timer = copy(self)
+        timer.reset()
+        n_timesteps = 0
+        while timer.date < timer.final_date:
+            next(timer)
+            n_timesteps += 1
+        return n_timesteps
+
     def _apply_activity_hierarchy(self, activities):
         """
         Returns a list of activities with the right order,
@@ -1,3 +1,4 @@
+from abc import ABC, abstractmethod
 import torch
 import yaml
 
@@ -13,11 +14,16 @@ class TransmissionSampler:
         self.shift = shift
 
     def __call__(self, n):
-        maxi = self.max_infectiousness.rsample((n,))
-        shape = self.shape.rsample((n,))
-        rate = self.rate.rsample((n,))
-        shift = self.shift.rsample((n,))
-        return torch.vstack((maxi, shape, rate, shift))
+        """
+        Samples the infection parameters of n agents, n can also be a shape
+        such as (ensemble_size, n_agents).
+        """
+        sample_shape = (n,) if isinstance(n, int) else tuple(n)
+        maxi = self.max_infectiousness.rsample(sample_shape)
+        shape = self.shape.rsample(sample_shape)
+        rate = self.rate.rsample(sample_shape)
+        shift = self.shift.rsample(sample_shape)
+        return torch.stack((maxi, shape, rate, shift))
 
     @classmethod
     def from_file(cls, fpath=default_config_path):
@@ -35,17 +41,374 @@ class TransmissionSampler:
         return cls(**ret)
 
 
+def _lowbias32(x):
+    """
+    Integer hash of the low 32 bits of x (lowbias32 by C. Wellons), computed
+    in int64 so that the products wrap within the low 32 bits.
+    """
+    mask = 0xFFFFFFFF
+    x = x & mask
+    x = x ^ (x >> 16)
+    x = (x * 0x7FEB352D) & mask
+    x = x ^ (x >> 15)
+    x = (x * 0x846CA68B) & mask
+    x = x ^ (x >> 16)
+    return x
+
+
+class LazyInfectionParameters:
+    """
+    Infection parameters of the agents that are only drawn when they are
+    needed. The value of each parameter of each agent is the inverse CDF of
+    its distribution at a uniform number hashed from the seed, the agent
+    index (in the flattened agent state) and the parameter, so it does not
+    depend on when or in which order agents are drawn. Values drawn for the
+    infected agents are kept in a table in infection order, with the row of
+    each agent in `slots`.
+
+    Indexing with a parameter name returns the values of all the agents,
+    which are cached unless they require gradients. The cache is not pickled,
+    so saved run states only hold the drawn table.
+    """
+
+    keys = ("max_infectiousness", "shape", "rate", "shift")
+
+    def __init__(self, sampler, state_shape, seed, device="cpu"):
+        self.distributions = {key: getattr(sampler, key) for key in self.keys}
+        for key, distribution in self.distributions.items():
+            try:
+                distribution.icdf(torch.tensor(0.5, device=device))
+            except NotImplementedError:
+                raise ValueError(
+                    f"The distribution of {key} has no inverse CDF, "
+                    "it cannot be sampled lazily."
+                )
+        self.state_shape = tuple(state_shape)
+        self.seed = seed
+        self.device = device
+        n_agents = 1
+        for size in self.state_shape:
+            n_agents *= size
+        self.slots = -torch.ones(n_agents, dtype=torch.int32, device=device)
+        self.table = torch.zeros((len(self.keys), 0), device=device)
+        self.n_drawn = 0
+        self._values = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_values"] = {}
+        return state
+
+    def _draw(self, agents):
+        """
+        Returns the parameters of the given agents, with shape
+        (n_parameters, n_agents).
+        """
+        agents = agents.long()
+        seed = _lowbias32(torch.tensor(self.seed, device=agents.device))
+        ret = []
+        for i, key in enumerate(self.keys):
+            counter = agents * len(self.keys) + i
+            hashed = _lowbias32(_lowbias32(counter >> 32 ^ seed) ^ counter)
+            # 24 bits, exact in float32 and strictly inside (0, 1)
+            uniform = ((hashed >> 8).float() + 0.5) / 2**24
+            ret.append(self.distributions[key].icdf(uniform))
+        return torch.stack(ret)
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        agents = torch.arange(self.slots.shape[0], device=self.device)
+        values = self._draw(agents)[self.keys.index(key)].reshape(self.state_shape)
+        if not values.requires_grad and not torch.is_inference_mode_enabled():
+            self._values[key] = values
+        return values
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys]
+
+    def gather(self, agents):
+        """
+        Returns the parameters of the agents with the given flat indices,
+        drawing and storing the ones of the agents not seen before.
+        """
+        # the table is a plain tensor even when drawing in inference mode
+        with torch.inference_mode(False), torch.no_grad():
+            agents = agents.clone()
+            new_agents = agents[self.slots[agents] < 0]
+            if len(new_agents) > 0:
+                self._store(new_agents)
+            slots = self.slots[agents].long()
+        return {key: self.table[i, slots] for i, key in enumerate(self.keys)}
+
+    def _store(self, agents):
+        n_drawn = self.n_drawn + len(agents)
+        if n_drawn > self.table.shape[1]:
+            capacity = max(n_drawn, 2 * self.table.shape[1])
+            table = torch.zeros((len(self.keys), capacity), device=self.device)
+            table[:, : self.n_drawn] = self.table[:, : self.n_drawn]
+            self.table = table
+        self.table[:, self.n_drawn : n_drawn] = self._draw(agents)
+        self.slots[agents] = torch.arange(
+            self.n_drawn, n_drawn, dtype=torch.int32, device=self.device
+        )
+        self.n_drawn = n_drawn
+
+
+class InfectiousnessKernel(ABC):
+    """
+    Infectiousness profile of an agent as a function of the time since its
+    infection shifted by `shift`, before it is scaled by
+    `max_infectiousness`. Kernels can precompute per agent constants from the
+    fixed `shape` and `rate` parameters with `compute_constants`, which
+    `get_constants` caches for the parameters of all the agents.
+    """
+
+    def __init__(self):
+        self._constants_key = None
+        self._constants = None
+
+    @classmethod
+    def from_parameters(cls, params):
+        return cls()
+
+    def compute_constants(self, shape, rate):
+        return ()
+
+    def get_constants(self, shape, rate):
+        if shape.requires_grad or rate.requires_grad:
+            return self.compute_constants(shape, rate)
+        key = (
+            shape,
+            rate,
+            shape._version,
+            rate._version,
+            torch.is_inference_mode_enabled(),
+        )
+        if self._constants_key is None or any(
+            a is not b if torch.is_tensor(a) else a != b
+            for a, b in zip(key, self._constants_key)
+        ):
+            self._constants_key = key
+            self._constants = self.compute_constants(shape, rate)
+        return self._constants
+
+    @abstractmethod
+    def __call__(self, time_from_shift, shape, rate, constants):
+        pass
+
+
+class GammaKernel(InfectiousnessKernel):
+    """
+    Gamma PDF profile evaluated in log space, with -lgamma(shape) and
+    log(rate) as per agent constants.
+    """
+
+    def compute_constants(self, shape, rate):
+        return -torch.lgamma(shape), torch.log(rate)
+
+    def __call__(self, time_from_shift, shape, rate, constants):
+        neg_lgamma_shape, log_rate = constants
+        is_positive = time_from_shift > 0
+        # keeps the log (and its gradient) finite before the shift
+        time_from_shift = torch.where(
+            is_positive, time_from_shift, torch.ones_like(time_from_shift)
+        )
+        log_profile = (
+            neg_lgamma_shape
+            + (shape - 1.0) * (torch.log(time_from_shift) + log_rate)
+            - time_from_shift * rate
+            + log_rate
+        )
+        return torch.where(
+            is_positive, torch.exp(log_profile), torch.zeros_like(log_profile)
+        )
+
+
+class TabulatedGammaKernel(InfectiousnessKernel):
+    """
+    Gamma PDF profile tabulated on a time grid for clusters of agents, and
+    evaluated by linear interpolation, whose derivative with respect to time
+    is the slope of the table. Agents are clustered by the quantile bin of
+    their `shape` and `rate` in the distributions they are drawn from, and
+    each cluster uses the profile of the centre of its bins. The profile is
+    not differentiable with respect to `shape` and `rate`.
+
+    Against the profile of the cluster centre, the interpolation error is
+    below 1e-2 after the first time step. In the first step the profile grows
+    like t^(shape - 1) and the error reaches ~3e-2. Against the exact profile
+    of each agent, agents in the outer quantile bins add an error of up to
+    ~5e-2 with 32 bins, but the mean error is below 1e-3.
+
+    Parameters
+    ----------
+    shape_distribution, rate_distribution:
+        distributions of the shape and rate parameters, they need an
+        inverse CDF.
+    n_bins:
+        number of quantile bins of each of shape and rate.
+    time_step:
+        spacing of the time grid, in days.
+    max_time:
+        the profile is 0 after max_time days from the shift.
+    """
+
+    def __init__(
+        self,
+        shape_distribution,
+        rate_distribution,
+        n_bins=16,
+        time_step=0.05,
+        max_time=30.0,
+        device="cpu",
+    ):
+        super().__init__()
+        self.n_bins = n_bins
+        self.time_step = time_step
+        quantiles = torch.arange(1, n_bins, device=device) / n_bins
+        centres = (torch.arange(n_bins, device=device) + 0.5) / n_bins
+        try:
+            self.shape_edges = shape_distribution.icdf(quantiles)
+            self.rate_edges = rate_distribution.icdf(quantiles)
+            shape = shape_distribution.icdf(centres)
+            rate = rate_distribution.icdf(centres)
+        except NotImplementedError:
+            raise ValueError("The tabulated kernel needs distributions with an icdf.")
+        # (n_bins * n_bins, 1) clusters, shape major
+        shape = shape.repeat_interleave(n_bins).unsqueeze(-1)
+        rate = rate.repeat(n_bins).unsqueeze(-1)
+        times = torch.arange(int(max_time / time_step) + 1, device=device)
+        times = times * time_step
+        gamma = GammaKernel()
+        self.table = gamma(times, shape, rate, gamma.compute_constants(shape, rate))
+
+    @classmethod
+    def from_parameters(cls, params):
+        sampler = TransmissionSampler.from_parameters(params)
+        return cls(
+            shape_distribution=sampler.shape,
+            rate_distribution=sampler.rate,
+            device=params["system"]["device"],
+        )
+
+    def compute_constants(self, shape, rate):
+        shape_bins = torch.bucketize(shape.detach(), self.shape_edges)
+        rate_bins = torch.bucketize(rate.detach(), self.rate_edges)
+        return (shape_bins * self.n_bins + rate_bins,)
+
+    def __call__(self, time_from_shift, shape, rate, constants):
+        (clusters,) = constants
+        clusters = clusters.expand(time_from_shift.shape)
+        position = time_from_shift / self.time_step
+        is_inside = (position > 0) & (position < self.table.shape[-1] - 1)
+        position = torch.where(is_inside, position, torch.zeros_like(position))
+        index = position.detach().long()
+        weight = position - index
+        return torch.where(
+            is_inside,
+            (1.0 - weight) * self.table[clusters, index]
+            + weight * self.table[clusters, index + 1],
+            torch.zeros_like(position),
+        )
+
+
+infectiousness_kernels = {"gamma": GammaKernel, "tabulated": TabulatedGammaKernel}
+
+
 class TransmissionUpdater(torch.nn.Module):
+    """
+    Computes the infectiousness of the agents, the infectiousness kernel (a
+    gamma profile by default) in the time since infection shifted by `shift`,
+    scaled by `max_infectiousness`. The kernel constants that only depend on
+    the fixed infection parameters of each agent are computed once. When
+    gradients are not required, the profile is only evaluated for the
+    infected agents and scattered into a reused buffer.
+    """
+
+    def __init__(self, kernel=None):
+        super().__init__()
+        if kernel is None:
+            kernel = GammaKernel()
+        self.kernel = kernel
+        self._buffer = None
+
+    @classmethod
+    def from_parameters(cls, params):
+        name = params["system"].get("infectiousness_kernel", "gamma")
+        if name not in infectiousness_kernels:
+            raise ValueError(
+                f"Infectiousness kernel {name} not supported, "
+                f"use one of {tuple(infectiousness_kernels)}."
+            )
+        return cls(kernel=infectiousness_kernels[name].from_parameters(params))
+
+    def _get_buffer(self, shape, dtype, device):
+        buffer = self._buffer
+        if (
+            buffer is None
+            or buffer.shape != shape
+            or buffer.dtype != dtype
+            or buffer.device != device
+            or buffer.is_inference() != torch.is_inference_mode_enabled()
+        ):
+            buffer = torch.zeros(shape, dtype=dtype, device=device)
+            self._buffer = buffer
+        else:
+            buffer.zero_()
+        return buffer
+
     def forward(self, data, timer):
-        shape = data["agent"]["infection_parameters"]["shape"]
-        shift = data["agent"]["infection_parameters"]["shift"]
-        rate = data["agent"]["infection_parameters"]["rate"]
-        max_infectiousness = data["agent"]["infection_parameters"]["max_infectiousness"]
+        infection_parameters = data["agent"]["infection_parameters"]
+        is_infected = data["agent"].is_infected
         time_from_infection = timer.now - data["agent"].infection_time
-        sign = (torch.sign(time_from_infection - shift + 1e-10) + 1) / 2
-        aux = torch.exp(-torch.lgamma(shape)) * torch.pow(
-            (time_from_infection - shift) * rate, shape - 1.0
+        if torch.is_grad_enabled():
+            # the gradient flows to every agent through is_infected
+            shape = infection_parameters["shape"]
+            rate = infection_parameters["rate"]
+            profile = self.kernel(
+                time_from_infection - infection_parameters["shift"],
+                shape,
+                rate,
+                self.kernel.get_constants(shape, rate),
+            )
+            return infection_parameters["max_infectiousness"] * profile * is_infected
+        if isinstance(infection_parameters, LazyInfectionParameters):
+            state_shape = torch.broadcast_shapes(
+                is_infected.shape, infection_parameters.state_shape
+            )
+        else:
+            state_shape = torch.broadcast_shapes(
+                is_infected.shape, infection_parameters["shape"].shape
+            )
+        infected = torch.nonzero(is_infected.expand(state_shape).reshape(-1))
+        infected = infected.squeeze(-1)
+
+        def gather(value):
+            return value.expand(state_shape).reshape(-1)[infected]
+
+        if isinstance(infection_parameters, LazyInfectionParameters):
+            # parameters are drawn the first time an agent is infected
+            parameters = infection_parameters.gather(infected)
+            constants = self.kernel.compute_constants(
+                parameters["shape"], parameters["rate"]
+            )
+        else:
+            parameters = {
+                key: gather(value) for key, value in infection_parameters.items()
+            }
+            constants = tuple(
+                gather(value)
+                for value in self.kernel.get_constants(
+                    infection_parameters["shape"], infection_parameters["rate"]
+                )
+            )
+        profile = self.kernel(
+            gather(time_from_infection) - parameters["shift"],
+            parameters["shape"],
+            parameters["rate"],
+            constants,
         )
-        aux2 = torch.exp((shift - time_from_infection) * rate) * rate
-        ret = max_infectiousness * sign * aux * aux2 * data["agent"].is_infected
+        values = parameters["max_infectiousness"] * profile * gather(is_infected)
+        ret = self._get_buffer(state_shape, values.dtype, values.device)
+        ret.view(-1)[infected] = values
         return ret
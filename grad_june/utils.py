@@ -7,6 +7,7 @@ import datetime
 import random
 from typing import Union
 from copy import deepcopy
+from torch.utils.weak import WeakTensorKeyDictionary
 from torch_geometric.data import HeteroData
 import torch_geometric.transforms as T
 
@@ -94,6 +95,152 @@ def fix_seed(seed=None):
     torch.cuda.manual_seed_all(seed)
 
 
+def get_agent_group_index(edge_index, n_agents):
+    """
+    Returns the group each agent attends, with -1 for agents not attending
+    any. Returns None if some agent attends more than one group.
+    """
+    agents, groups = edge_index
+    if len(torch.unique(agents)) != len(agents):
+        return None
+    ret = -torch.ones(n_agents, dtype=groups.dtype, device=groups.device)
+    ret[agents.long()] = groups
+    return ret
+
+
+def add_group_indices(data):
+    """
+    Adds the `<group>_group_index` of the single membership networks to the
+    agents of graphs saved without it, deriving it from the `attends_<group>`
+    edges. Leisure is skipped since people attend several venues.
+    """
+    n_agents = len(data["agent"].id)
+    for edge_type in data.edge_types:
+        relation = edge_type[1]
+        if not relation.startswith("attends_") or relation == "attends_leisure":
+            continue
+        key = f"{relation[len('attends_'):]}_group_index"
+        if key in data["agent"]:
+            continue
+        group_index = get_agent_group_index(data[edge_type].edge_index, n_agents)
+        if group_index is not None:
+            data["agent"][key] = group_index
+    return data
+
+
+def cast_indices(data, index_dtype=torch.long):
+    """
+    Casts the edge indices of the graph and the per agent group indices to
+    `index_dtype`. Storing them as int32 halves the memory of the graph, the
+    infection networks use them (and build their sparse incidences) in that
+    dtype.
+    """
+    for edge_type in data.edge_types:
+        data[edge_type].edge_index = data[edge_type].edge_index.to(index_dtype)
+    for key in list(data["agent"].keys()):
+        if key.endswith("_group_index"):
+            data["agent"][key] = data["agent"][key].to(index_dtype)
+    return data
+
+
+def drop_reverse_edges(data):
+    """
+    Removes the `rev_*` edges of graphs saved with them. The infection
+    networks do not use them, and `get_reverse_edge_index` serves their
+    transpose to the code that does.
+    """
+    for edge_type in data.edge_types:
+        if edge_type[1].startswith("rev_"):
+            del data[edge_type]
+    return data
+
+
+_reverse_edge_indices = WeakTensorKeyDictionary()
+
+
+def get_reverse_edge_index(data, relation):
+    """
+    Returns the edge index of the `rev_<relation>` edges. Graphs loaded
+    without materialized reverse edges get the transpose of the `relation`
+    edges, built the first time it is needed and cached while the forward
+    edges are alive, so networks sharing edges also share their transpose.
+    """
+    for edge_type in data.edge_types:
+        if edge_type[1] == f"rev_{relation}":
+            return data[edge_type].edge_index
+    edge_index = data[relation].edge_index
+    if edge_index not in _reverse_edge_indices:
+        _reverse_edge_indices[edge_index] = edge_index.flip(0)
+    return _reverse_edge_indices[edge_index]
+
+
+_propagation_indices = WeakTensorKeyDictionary()
+
+
+def get_propagation_index(edge_index, reverse=False):
+    """
+    Returns the edge index in the int64 dtype that torch_geometric scatters
+    over, transposed with `reverse`. When a copy is needed it is built the
+    first time and cached while the edges are alive, so networks sharing
+    edges also share it.
+    """
+    if edge_index.dtype == torch.long and not reverse:
+        return edge_index
+    if edge_index not in _propagation_indices:
+        _propagation_indices[edge_index] = {}
+    indices = _propagation_indices[edge_index]
+    if reverse not in indices:
+        ret = edge_index.long()
+        indices[reverse] = ret.flip(0) if reverse else ret
+    return indices[reverse]
+
+
+def share_memory(data):
+    """
+    Moves every tensor of the graph, including the ones in dictionaries such
+    as the symptoms, to shared memory so that worker processes read the same
+    copy. Returns the graph.
+    """
+
+    def share(value):
+        if torch.is_tensor(value):
+            value.share_memory_()
+        elif isinstance(value, dict):
+            for item in value.values():
+                share(item)
+
+    for store in data.stores:
+        for value in store.values():
+            share(value)
+    return data
+
+
+def update_parameters(params, overrides):
+    """
+    Returns a copy of the parameters with the (nested) values in overrides
+    replaced.
+    """
+    ret = deepcopy(params)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(ret.get(key), dict):
+            ret[key] = update_parameters(ret[key], value)
+        else:
+            ret[key] = deepcopy(value)
+    return ret
+
+
+def get_dtype(name):
+    """
+    Returns the torch dtype with the given name, e.g. "int32" or "bfloat16".
+    Aliases such as "float" or "long" are not accepted, so the width of the
+    type is always explicit.
+    """
+    dtype = getattr(torch, name, None)
+    if not isinstance(dtype, torch.dtype) or str(dtype) != f"torch.{name}":
+        raise ValueError(f"Unknown dtype {name}.")
+    return dtype
+
+
 def create_simple_connected_graph(n_agents):
     # avoid circular import
     from grad_june.transmission import TransmissionSampler
@@ -1,4 +1,5 @@
 import torch
+import pytest
 import numpy as np
 from pytest import fixture
 from torch_geometric.data import HeteroData
@@ -8,8 +9,13 @@ from grad_june.infection_networks import InfectionNetworks
 from grad_june.infection import IsInfectedSampler
 from grad_june.infection_networks.base import (
     SchoolNetwork,
+    CompanyNetwork,
+    HouseholdNetwork,
 )
-from grad_june.policies import Policies
+from grad_june.infection_networks.step_cache import StepCache
+from grad_june.policies import Policies, Quarantine
+from grad_june.timer import Timer
+from grad_june.utils import cast_indices, add_group_indices, get_propagation_index
 
 
 class TestInfectionNetworks:
@@ -43,6 +49,254 @@ class TestInfectionNetworks:
         expected = np.exp(-np.array([1.2, 2.4, 3.6, 1.5, 2.1, 3]))
         assert np.allclose(infection_probabilities.detach().numpy(), expected)
 
+    def test__sparse_backend(self, small_data, school_timer):
+        grads = []
+        for backend in ("message_passing", "edges", "sparse"):
+            log_beta = torch.nn.Parameter(torch.tensor(np.log10(2.0)))
+            networks = InfectionNetworks(
+                school=SchoolNetwork(log_beta=log_beta, backend=backend)
+            )
+            infection_probabilities = networks(
+                data=small_data, timer=school_timer, policies=Policies()
+            )
+            expected = np.exp(-np.array([1.2, 2.4, 3.6, 1.5, 2.1, 3]))
+            assert np.allclose(infection_probabilities.detach().numpy(), expected)
+            infection_probabilities.sum().backward()
+            grads.append(log_beta.grad.item())
+        assert np.allclose(grads, grads[0])
+
+    def test__two_stage_gradients(self, small_data, school_timer):
+        grads = []
+        for backend in ("message_passing", "edges", "sparse"):
+            log_beta = torch.nn.Parameter(torch.tensor(np.log10(2.0)))
+            transmission = small_data["agent"].transmission.detach().clone()
+            susceptibility = small_data["agent"].susceptibility.detach().clone()
+            transmission.requires_grad_()
+            susceptibility.requires_grad_()
+            small_data["agent"].transmission = transmission
+            small_data["agent"].susceptibility = susceptibility
+            network = SchoolNetwork(log_beta=log_beta, backend=backend)
+            trans_susc = network(
+                data=small_data, timer=school_timer, policies=Policies()
+            )
+            (trans_susc * torch.arange(6)).sum().backward()
+            grads.append((log_beta.grad, transmission.grad, susceptibility.grad))
+        for backend_grads in grads[1:]:
+            for grad_mp, grad_backend in zip(grads[0], backend_grads):
+                assert torch.allclose(grad_mp, grad_backend)
+
+    def test__without_reverse_edges(self, networks, small_data, school_timer):
+        del small_data["rev_attends_school"]
+        infection_probabilities = networks(
+            data=small_data, timer=school_timer, policies=Policies()
+        )
+        expected = np.exp(-np.array([1.2, 2.4, 3.6, 1.5, 2.1, 3]))
+        assert np.allclose(infection_probabilities.detach().numpy(), expected)
+
+    @pytest.mark.parametrize("backend", ["message_passing", "edges", "sparse"])
+    def test__int32_indices(self, small_data, school_timer, backend):
+        small_data = cast_indices(small_data, torch.int32)
+        sn = SchoolNetwork(log_beta=np.log10(2.0), backend=backend)
+        networks = InfectionNetworks(school=sn)
+        infection_probabilities = networks(
+            data=small_data, timer=school_timer, policies=Policies()
+        )
+        expected = np.exp(-np.array([1.2, 2.4, 3.6, 1.5, 2.1, 3]))
+        assert np.allclose(infection_probabilities.detach().numpy(), expected)
+        if backend == "message_passing":
+            # the int64 copy of the edges is built once
+            edge_index = small_data["attends_school"].edge_index
+            long_edge_index = get_propagation_index(edge_index)
+            assert long_edge_index.dtype == torch.long
+            assert get_propagation_index(edge_index) is long_edge_index
+        if backend == "sparse":
+            incidence = sn._get_incidence(small_data)
+            assert incidence.agents_to_groups.crow_indices().dtype == torch.int32
+            assert incidence.agents_to_groups.col_indices().dtype == torch.int32
+
+    @pytest.mark.parametrize("backend", ["message_passing", "edges", "sparse"])
+    def test__ensemble(self, small_data, school_timer, backend):
+        small_data["agent"].transmission = small_data["agent"].transmission.repeat(2, 1)
+        small_data["agent"].susceptibility = small_data["agent"].susceptibility.repeat(
+            2, 1
+        )
+        sn = SchoolNetwork(log_beta=[np.log10(2.0), np.log10(4.0)], backend=backend)
+        networks = InfectionNetworks(school=sn)
+        infection_probabilities = networks(
+            data=small_data, timer=school_timer, policies=Policies()
+        )
+        assert infection_probabilities.shape == (2, 6)
+        expected = np.array([1.2, 2.4, 3.6, 1.5, 2.1, 3])
+        assert np.allclose(
+            infection_probabilities.detach().numpy(),
+            np.exp(-np.vstack((expected, 2 * expected))),
+        )
+
+    def test__p_contact_cache(self, networks, small_data, school_timer):
+        networks(data=small_data, timer=school_timer, policies=Policies())
+        sn = networks["school"]
+        p_contact = sn.p_contact
+        assert (p_contact == torch.tensor([1.0, 1.0])).all()
+        networks(data=small_data, timer=school_timer, policies=Policies())
+        assert sn.p_contact is p_contact
+        # replacing the graph invalidates the cache
+        small_data["school"].people = torch.tensor([3, 5])
+        networks(data=small_data, timer=school_timer, policies=Policies())
+        assert (sn.p_contact == torch.tensor([0.5, 0.25])).all()
+
+    @pytest.mark.parametrize("backend", ["message_passing", "sparse"])
+    def test__single_membership_gather(self, small_data, school_timer, backend):
+        small_data["agent"].school_group_index = torch.tensor([0, 0, 0, 1, 1, 1])
+        networks = InfectionNetworks(
+            school=SchoolNetwork(log_beta=np.log10(2.0), backend=backend)
+        )
+        infection_probabilities = networks(
+            data=small_data, timer=school_timer, policies=Policies()
+        )
+        expected = np.exp(-np.array([1.2, 2.4, 3.6, 1.5, 2.1, 3]))
+        assert np.allclose(infection_probabilities.detach().numpy(), expected)
+        # agents outside any school
+        small_data["agent"].school_group_index = torch.tensor([0, 0, -1, 1, 1, -1])
+        infection_probabilities = networks(
+            data=small_data, timer=school_timer, policies=Policies()
+        )
+        expected = np.exp(-np.array([1.2, 2.4, 0.0, 1.5, 2.1, 0.0]))
+        assert np.allclose(infection_probabilities.detach().numpy(), expected)
+
+    @pytest.mark.parametrize("backend", ["message_passing", "sparse"])
+    def test__derived_group_index(self, small_data, school_timer, backend):
+        networks = InfectionNetworks(
+            school=SchoolNetwork(log_beta=np.log10(2.0), backend=backend)
+        )
+        expected = networks(data=small_data, timer=school_timer, policies=Policies())
+        small_data = add_group_indices(small_data)
+        assert (
+            small_data["agent"].school_group_index
+            == torch.tensor([0, 0, 0, 1, 1, 1])
+        ).all()
+        result = networks(data=small_data, timer=school_timer, policies=Policies())
+        assert torch.allclose(result, expected)
+
+    @pytest.mark.parametrize("backend", ["message_passing", "sparse"])
+    def test__active_set(self, small_data, school_timer, backend):
+        small_data["agent"].transmission = torch.tensor([0.1, 0, 0, 0.4, 0, 0])
+        sn = SchoolNetwork(log_beta=np.log10(2.0), backend=backend)
+        dense = InfectionNetworks(school=sn)
+        active = InfectionNetworks(school=sn, active_set_threshold=0.5)
+        with torch.no_grad():
+            assert (
+                active._get_active_agents(small_data) == torch.tensor([0, 3])
+            ).all()
+            expected = dense(data=small_data, timer=school_timer, policies=Policies())
+            result = active(data=small_data, timer=school_timer, policies=Policies())
+            assert torch.allclose(result, expected)
+            # above the threshold the dense path is used
+            active.active_set_threshold = 0.1
+            assert active._get_active_agents(small_data) is None
+        # with autograd all the agents are propagated
+        active.active_set_threshold = 0.5
+        assert active._get_active_agents(small_data) is None
+
+    @pytest.mark.parametrize("backend", ["message_passing", "sparse"])
+    def test__active_set_gradients(self, small_data, school_timer, backend):
+        grads = []
+        for threshold in (None, 0.5):
+            is_infected = torch.tensor([1.0, 0, 0, 1.0, 0, 0], requires_grad=True)
+            small_data["agent"].transmission = is_infected * 0.5
+            networks = InfectionNetworks(
+                school=SchoolNetwork(log_beta=np.log10(2.0), backend=backend),
+                active_set_threshold=threshold,
+            )
+            probs = networks(data=small_data, timer=school_timer, policies=Policies())
+            probs.sum().backward()
+            grads.append(is_infected.grad)
+        assert (grads[0][[1, 2, 4, 5]] != 0).all()
+        assert torch.allclose(grads[0], grads[1])
+
+    @pytest.mark.parametrize("backend", ["message_passing", "sparse"])
+    def test__susceptible_set(self, small_data, school_timer, backend):
+        small_data["agent"].susceptibility = torch.tensor([0, 2.0, 0, 0, 0.7, 0])
+        sn = SchoolNetwork(log_beta=np.log10(2.0), backend=backend)
+        dense = InfectionNetworks(school=sn)
+        pruned = InfectionNetworks(school=sn, susceptible_set_threshold=0.5)
+        with torch.no_grad():
+            assert (
+                pruned._get_susceptible_agents(small_data) == torch.tensor([1, 4])
+            ).all()
+            expected = dense(data=small_data, timer=school_timer, policies=Policies())
+            result = pruned(data=small_data, timer=school_timer, policies=Policies())
+            assert torch.allclose(result, expected)
+        assert pruned._get_susceptible_agents(small_data) is None
+
+    @pytest.mark.parametrize("backend", ["message_passing", "sparse"])
+    def test__susceptible_set_gradients(self, small_data, school_timer, backend):
+        grads = []
+        for threshold in (None, 0.5):
+            is_infected = torch.tensor([1.0, 0, 1.0, 1.0, 0, 1.0], requires_grad=True)
+            small_data["agent"].susceptibility = 1.0 - is_infected
+            networks = InfectionNetworks(
+                school=SchoolNetwork(log_beta=np.log10(2.0), backend=backend),
+                susceptible_set_threshold=threshold,
+            )
+            probs = networks(data=small_data, timer=school_timer, policies=Policies())
+            probs.sum().backward()
+            grads.append(is_infected.grad)
+        assert torch.allclose(grads[0], grads[1])
+
+    def test__fuse_activities(self, inf_data):
+        data = inf_data
+        data["agent"].transmission = torch.rand(100) * data["agent"].is_infected
+        data["agent"].symptoms["current_stage"] = torch.randint(0, 6, (100,))
+        networks = {
+            "household": HouseholdNetwork(log_beta=0.1),
+            "company": CompanyNetwork(log_beta=-0.2),
+            "school": SchoolNetwork(log_beta=0.3),
+        }
+        timer = Timer(
+            initial_day="2022-02-04",
+            total_days=10,
+            weekday_step_duration=(24,),
+            weekend_step_duration=(24,),
+            weekday_activities=(("company", "school", "household"),),
+            weekend_activities=(("household",),),
+        )
+        quarantine = Quarantine(
+            stage_threshold=3,
+            start_date="2022-02-01",
+            end_date="2022-03-15",
+            device="cpu",
+        )
+        policies = Policies.from_policy_list([quarantine])
+        separate = InfectionNetworks(**networks)
+        fused = InfectionNetworks(fuse_activities=True, **networks)
+        for _ in range(3):
+            expected = separate(data=data, timer=timer, policies=policies)
+            result = fused(data=data, timer=timer, policies=policies)
+            assert torch.allclose(result, expected)
+            next(timer)
+        assert len(fused._activity_incidences) == 2
+
+    def test__step_cache(self, small_data, school_timer):
+        cache = StepCache()
+        sn = SchoolNetwork(log_beta=np.log10(2.0))
+        cn = CompanyNetwork(log_beta=np.log10(2.0))
+        transmissions = sn._get_transmissions(
+            data=small_data, policies=Policies(), timer=school_timer, cache=cache
+        )
+        assert ("transmission", True) in cache
+        # networks with the same quarantine mask share the masked state
+        assert (
+            cn._get_transmissions(
+                data=small_data, policies=Policies(), timer=school_timer, cache=cache
+            )
+            is transmissions
+        )
+        infection_probabilities = InfectionNetworks(school=sn)(
+            data=small_data, timer=school_timer, policies=Policies()
+        )
+        expected = np.exp(-np.array([1.2, 2.4, 3.6, 1.5, 2.1, 3]))
+        assert np.allclose(infection_probabilities.detach().numpy(), expected)
+
 
 # def test__people_only_active_once(self, timer, inf_data):
 #     data = inf_data
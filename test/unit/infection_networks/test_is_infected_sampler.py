@@ -23,3 +23,14 @@ class TestIsInfectedSampler:
         ret = ret / n
         assert np.allclose(ret, 1.0 - probs, rtol=1e-1)
 
+    def test__sample_bernoulli(self):
+        sampler = IsInfectedSampler()
+        probs = torch.tensor([0.2, 0.5, 0.7, 0.3])
+        n = 2000
+        ret = torch.zeros(4)
+        for _ in range(n):
+            new_infected = sampler.sample(probs)
+            assert new_infected.dtype == torch.bool
+            ret += new_infected
+        ret = ret / n
+        assert np.allclose(ret, 1.0 - probs, rtol=1e-1)
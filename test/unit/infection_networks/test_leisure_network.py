@@ -3,7 +3,16 @@ import torch
 import numpy as np
 from torch_geometric.data import HeteroData
 
-from grad_june.infection_networks.leisure_network import LeisureNetwork
+from grad_june.infection_networks import InfectionNetworks
+from grad_june.infection_networks.leisure_network import (
+    LeisureNetwork,
+    PubNetwork,
+    CinemaNetwork,
+    GroceryNetwork,
+    GymNetwork,
+    VisitNetwork,
+    CareVisitNetwork,
+)
 from grad_june.policies import Policies
 from grad_june.timer import Timer
 import torch_geometric.transforms as T
@@ -75,3 +84,38 @@ class TestLeisureNetwork:
         assert (susc == 0.5 * torch.tensor([1.0, 1.0, 1.0, 1.0, 1.0])).all()
         trans = ln._get_transmissions(data=data, policies=policies, timer=timer)
         assert (trans == 2.0 * torch.tensor([1.0, 1.0, 1.0, 1.0, 1.0])).all()
+
+    def test__fused_propagation(self, data, leisure_probabilities):
+        data["leisure"].people = torch.tensor([3, 0, 0])
+        data["agent"].age = torch.tensor([1, 60, 80, 30, 90])
+        network_classes = {
+            "pub": PubNetwork,
+            "cinema": CinemaNetwork,
+            "grocery": GroceryNetwork,
+            "gym": GymNetwork,
+            "visit": VisitNetwork,
+            "care_visit": CareVisitNetwork,
+        }
+        networks = {
+            name: network_class(
+                log_beta=-0.5 + 0.1 * i,
+                device="cpu",
+                leisure_probabilities=leisure_probabilities,
+                backend="sparse",
+            )
+            for i, (name, network_class) in enumerate(network_classes.items())
+        }
+        timer = Timer(
+            initial_day="2022-05-20",
+            weekday_step_duration=(24,),
+            weekend_step_duration=(24,),
+            weekday_activities=(tuple(network_classes),),
+            weekend_activities=(tuple(network_classes),),
+        )
+        separate = InfectionNetworks(**networks)
+        fused = InfectionNetworks(fuse_shared_edges=True, **networks)
+        for _ in range(2):
+            expected = separate(data=data, timer=timer, policies=Policies())
+            result = fused(data=data, timer=timer, policies=Policies())
+            assert torch.allclose(result, expected)
+            next(timer)
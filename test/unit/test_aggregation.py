@@ -0,0 +1,44 @@
+import numpy as np
+import torch
+from pytest import fixture
+from torch_geometric.data import HeteroData
+
+from grad_june.aggregation import Aggregator
+
+
+class TestAggregator:
+    @fixture(name="data")
+    def make_data(self):
+        data = HeteroData()
+        data["agent"].id = torch.arange(6)
+        data["agent"].age = torch.tensor([5, 18, 30, 70, 99, 100])
+        data["agent"].sex = torch.tensor([0, 1, 1, 0, 1, 0])
+        data["agent"].ethnicity = np.array(["C", "A", "A", "B", "C", "A"])
+        return data
+
+    def test__aggregate(self, data):
+        aggregator = Aggregator(data, attributes=("age", "sex", "ethnicity"))
+        assert aggregator.labels["age"] == [18, 65, 100]
+        assert aggregator.labels["sex"] == [0, 1]
+        assert aggregator.labels["ethnicity"] == ["A", "B", "C"]
+        values = torch.tensor([1.0, 2.0, 3.0, 4.0, 5.0, 6.0], requires_grad=True)
+        ret = aggregator.aggregate(values)
+        # ages on the bin edges are not counted
+        assert (ret["age"] == torch.tensor([1.0, 3.0, 9.0])).all()
+        assert (ret["sex"] == torch.tensor([11.0, 10.0])).all()
+        assert (ret["ethnicity"] == torch.tensor([11.0, 4.0, 6.0])).all()
+        ret["sex"][1].backward()
+        assert (values.grad == torch.tensor([0, 1, 1, 0, 1, 0.0])).all()
+
+    def test__aggregate_several_quantities(self, data):
+        aggregator = Aggregator(data, attributes=("sex",))
+        values = torch.stack((torch.ones(6), torch.arange(6.0)))
+        ret = aggregator.aggregate(values)
+        assert (ret["sex"] == torch.tensor([[3.0, 3.0], [8.0, 7.0]])).all()
+
+    def test__aggregate_stages(self, data):
+        aggregator = Aggregator(data, attributes=("age", "sex"))
+        stages = torch.tensor([0, 2, 2, 1, 0, 1])
+        ret = aggregator.aggregate_stages(stages, n_stages=3)
+        assert (ret["sex"] == torch.tensor([[1, 1], [2, 0], [0, 2.0]])).all()
+        assert (ret["age"] == torch.tensor([[1, 0, 1], [0, 0, 1], [0, 1, 0.0]])).all()
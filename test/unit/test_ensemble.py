@@ -0,0 +1,39 @@
+import numpy as np
+import yaml
+from pytest import fixture
+
+from grad_june.ensemble import EnsembleRunner
+from grad_june.paths import default_config_path
+
+
+class TestEnsembleRunner:
+    @fixture(name="ensemble_runner")
+    def make_ensemble_runner(self):
+        with open(default_config_path, "r") as f:
+            parameters = yaml.safe_load(f)
+        return EnsembleRunner(parameters, n_workers=2)
+
+    def test__shared_graph(self, ensemble_runner):
+        edge_index = ensemble_runner.data["attends_household"].edge_index
+        assert edge_index.is_shared()
+
+    def test__run(self, ensemble_runner):
+        parameter_list = [
+            {},
+            {},
+            {"networks": {"household": {"log_beta": 1.0}}},
+        ]
+        results = ensemble_runner.run(parameter_list, seeds=[1, 1, 2])
+        assert len(results) == 3
+        n_timesteps = 16
+        for run_results in results:
+            assert len(run_results["cases_per_timestep"]) == n_timesteps
+        # same parameters and seed give the same realization
+        assert np.allclose(
+            results[0]["cases_per_timestep"], results[1]["cases_per_timestep"]
+        )
+        df = EnsembleRunner.to_dataframe(results)
+        assert len(df) == 3 * n_timesteps
+        assert np.allclose(
+            df.loc[2]["cases_per_timestep"], results[2]["cases_per_timestep"]
+        )
@@ -11,6 +11,7 @@ from grad_june.june_world_loader.company_loader import CompanyNetworkLoader
 from grad_june.june_world_loader.school_loader import SchoolNetworkLoader
 from grad_june.june_world_loader.university_loader import UniversityNetworkLoader
 from grad_june.june_world_loader.leisure_loader import LeisureNetworkLoader
+from grad_june.utils import get_reverse_edge_index
 
 
 class TestLoadAgentData:
@@ -23,6 +24,7 @@ class TestLoadAgentData:
         agent_data_loader.load_agent_data(data)
         assert len(data["agent"]["id"]) == 769
         assert len(data["agent"]["area"]) == 769
+        assert len(data["agent"]["super_area"]) == 769
         assert len(data["agent"]["age"]) == 769
         assert len(data["agent"]["sex"]) == 769
         assert data["agent"]["age"][14] == 6
@@ -89,6 +91,11 @@ class TestNetworks:
         assert len(data[f"attends_{spec}"].edge_index[0]) == total_people
         for group_id, n_people in zip(group_ids, n_people_per_group):
             assert data[spec].people[group_id] == n_people
+        group_index = data["agent"][f"{spec}_group_index"]
+        assert len(group_index) == 769
+        assert (group_index >= 0).sum() == total_people
+        edge_index = data[f"attends_{spec}"].edge_index
+        assert (group_index[edge_index[0]] == edge_index[1]).all()
 
 
 class TestLeisureNetwork:
@@ -140,17 +147,17 @@ class TestLoadGraph:
         assert len(data["school"]["id"]) == 1
         assert len(data["company"]["id"]) == 1980
         assert len(data["attends_company"]["edge_index"][0]) == 333
-        assert len(data["rev_attends_company"]["edge_index"][0]) == 333
         assert len(data["attends_school"]["edge_index"][0]) == 78
-        assert len(data["rev_attends_school"]["edge_index"][0]) == 78
         assert len(data["attends_household"]["edge_index"][0]) == 745
-        assert len(data["rev_attends_household"]["edge_index"][0]) == 745
         assert (
             len(data["attends_care_home"]["edge_index"][0]) == 27
         )  # residents + workers
-        assert len(data["rev_attends_care_home"]["edge_index"][0]) == 27
         assert len(data["attends_leisure"]["edge_index"][0]) == 769
-        assert len(data["rev_attends_leisure"]["edge_index"][0]) == 769
+        # reverse edges are not stored but served as the transpose
+        assert not any(edge_type[1].startswith("rev_") for edge_type in data.edge_types)
+        rev_edge_index = get_reverse_edge_index(data, "attends_company")
+        assert (rev_edge_index == data["attends_company"].edge_index.flip(0)).all()
+        assert get_reverse_edge_index(data, "attends_company") is rev_edge_index
 
         goes_to_school = set(data["attends_school"].edge_index[0, :].numpy())
         goes_to_company = set(data["attends_company"].edge_index[0, :].numpy())
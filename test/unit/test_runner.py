@@ -2,11 +2,13 @@ import pytest
 import yaml
 import torch
 import os
+import datetime
 import numpy as np
 import pandas as pd
 from pathlib import Path
 
 from grad_june.runner import Runner
+from grad_june.policies import Policies
 from grad_june.paths import default_config_path
 
 
@@ -34,6 +36,10 @@ class TestRunner:
         assert inf_params["rate"].shape == n_agents
         assert inf_params["shift"].shape == n_agents
 
+    def test__no_reverse_edges(self, runner):
+        edge_types = runner.data.edge_types
+        assert not any(edge_type[1].startswith("rev_") for edge_type in edge_types)
+
     def test__seed(self, runner):
         runner.set_initial_cases()
         assert np.isclose(
@@ -58,6 +64,20 @@ class TestRunner:
         assert runner.data["agent"].symptoms["next_stage"].sum().item() == n_agents[0]
         assert runner.data["agent"].symptoms["time_to_next_stage"].sum().item() == 0
 
+    def test__restore_into_arena(self, runner):
+        runner.restore_initial_data()
+        susceptibility = runner.data["agent"].susceptibility
+        current_stage = runner.data["agent"].symptoms["current_stage"]
+        with torch.no_grad():
+            susceptibility.fill_(0.0)
+            current_stage.fill_(3)
+        runner.restore_initial_data()
+        # the state is restored into the same buffers
+        assert runner.data["agent"].susceptibility is susceptibility
+        assert runner.data["agent"].symptoms["current_stage"] is current_stage
+        assert (susceptibility == 1.0).all()
+        assert (current_stage == 1).all()
+
     def test__run_model(self, runner):
         results, is_infected = runner()
         n_timesteps = 16
@@ -68,6 +88,166 @@ class TestRunner:
         assert len(results["cases_by_age_65"]) == n_timesteps
         assert len(results["cases_by_age_100"]) == n_timesteps
         assert len(is_infected) == runner.n_agents
+        # breakdowns of deaths are opt in
+        assert not any(key.startswith("deaths_by") for key in results)
+
+    def test__cases_by_ethnicity(self, runner):
+        aggregator = runner.aggregator
+        cases = runner.get_cases_by_ethnicity(runner.data)
+        assert len(cases) == len(runner.ethnicities)
+        assert runner.aggregator is aggregator
+        # the ethnicity aggregator is built once
+        ethnicity_aggregator = runner._ethnicity_aggregator
+        runner.get_cases_by_ethnicity(runner.data)
+        assert runner._ethnicity_aggregator is ethnicity_aggregator
+        results, is_infected = runner()
+        assert not any(key.startswith("cases_by_ethnicity") for key in results)
+
+    def test__breakdowns(self):
+        with open(default_config_path, "r") as f:
+            parameters = yaml.safe_load(f)
+        parameters["aggregate_by"] = ["age", "sex"]
+        parameters["aggregate_stages"] = True
+        runner = Runner.from_parameters(parameters)
+        results, is_infected = runner()
+        cases_by_sex = results["cases_by_sex_0"] + results["cases_by_sex_1"]
+        assert torch.allclose(cases_by_sex, results["cases_per_timestep"])
+        deaths_by_sex = results["deaths_by_sex_0"] + results["deaths_by_sex_1"]
+        assert torch.allclose(deaths_by_sex, results["deaths_per_timestep"])
+        assert len(results["deaths_by_age_65"]) == 16
+        stages = runner.model.symptoms_updater.symptoms_sampler.stages
+        n_people = sum(results[f"{stage}_by_sex_0"] for stage in stages)
+        assert (n_people == (runner.data["agent"].sex == 0).sum()).all()
+
+    def test__ensemble(self):
+        with open(default_config_path, "r") as f:
+            parameters = yaml.safe_load(f)
+        parameters["system"]["ensemble_size"] = 3
+        parameters["networks"]["household"]["log_beta"] = [-0.5, -0.4, -0.3]
+        runner = Runner.from_parameters(parameters)
+        assert runner.data["agent"].susceptibility.shape == (3, runner.n_agents)
+        results, is_infected = runner()
+        assert is_infected.shape == (3, runner.n_agents)
+        assert results["cases_per_timestep"].shape == (16, 3)
+        assert results["deaths_per_timestep"].shape == (16, 3)
+        assert results["cases_by_age_18"].shape == (16, 3)
+        # members are independent realizations
+        assert not (is_infected[0] == is_infected[1]).all()
+        runner.save_results(results, is_infected)
+        loaded_results = pd.read_csv("./example/results.csv", index_col=0)
+        assert np.allclose(
+            loaded_results["cases_per_timestep_2"],
+            results["cases_per_timestep"][:, 2].detach().numpy(),
+        )
+
+    def test__checkpoint_window(self, runner):
+        grads = []
+        cases = []
+        for window in (None, 4):
+            runner.checkpoint_window = window
+            torch.manual_seed(0)
+            results, is_infected = runner()
+            cases.append(results["cases_per_timestep"].detach())
+            log_beta = runner.model.infection_networks.networks["household"].log_beta
+            log_beta.grad = None
+            results["cases_per_timestep"].sum().backward()
+            grads.append(log_beta.grad.clone())
+        assert torch.allclose(cases[0], cases[1])
+        assert torch.allclose(grads[0], grads[1])
+
+    def test__inference(self, runner):
+        runner.inference = True
+        results, is_infected = runner()
+        assert len(results["cases_per_timestep"]) == 16
+        # the returned infections are not overwritten by the next run
+        expected = is_infected.clone()
+        runner()
+        assert torch.equal(is_infected, expected)
+        assert not results["cases_per_timestep"].requires_grad
+        assert runner.data["agent"].symptoms["current_stage"].dtype == torch.long
+        assert results["cases_per_timestep"][-1] >= results["cases_per_timestep"][0]
+
+    def test__compact_storage(self):
+        with open(default_config_path, "r") as f:
+            parameters = yaml.safe_load(f)
+        parameters["system"]["index_dtype"] = "int32"
+        parameters["system"]["stage_dtype"] = "int8"
+        parameters["system"]["state_dtype"] = "bfloat16"
+        runner = Runner.from_parameters(parameters)
+        data = runner.data
+        assert data["attends_household"].edge_index.dtype == torch.int32
+        assert data["agent"].symptoms["current_stage"].dtype == torch.int8
+        assert data["agent"].susceptibility.dtype == torch.bfloat16
+        results, is_infected = runner()
+        assert len(results["cases_per_timestep"]) == 16
+        assert is_infected.dtype == torch.bfloat16
+
+    def test__resume(self, runner, tmp_path):
+        runner.state_path = tmp_path / "state.pt"
+        runner.save_state_every = 6
+        torch.manual_seed(0)
+        with torch.no_grad():
+            results, is_infected = runner()
+        # the last state saved is the one after 12 steps
+        torch.manual_seed(1)
+        with torch.no_grad():
+            resumed_results, resumed_is_infected = runner(
+                resume_from=runner.state_path
+            )
+        assert resumed_results["dates"] == results["dates"]
+        for key in ("cases_per_timestep", "deaths_per_timestep"):
+            assert torch.equal(resumed_results[key], results[key])
+        assert torch.equal(resumed_is_infected, is_infected)
+
+    def test__run_scenarios(self, runner):
+        default_policies = runner.model.policies
+        scenario_policies = [default_policies, Policies.from_policy_list([])]
+        torch.manual_seed(0)
+        with torch.no_grad():
+            scenarios = runner.run_scenarios(
+                "2022-02-08", scenario_policies, seeds=[0, 1]
+            )
+        assert runner.model.policies is default_policies
+        assert len(scenarios) == 2
+        (results_1, _), (results_2, _) = scenarios
+        assert results_1["dates"] == results_2["dates"]
+        assert len(results_1["cases_per_timestep"]) == 16
+        # the shared part of the run is the same for every scenario
+        fork_step = results_1["dates"].index(datetime.datetime(2022, 2, 8))
+        assert torch.equal(
+            results_1["cases_per_timestep"][: fork_step + 1],
+            results_2["cases_per_timestep"][: fork_step + 1],
+        )
+        # the same policies and seed reproduce the scenario
+        torch.manual_seed(0)
+        with torch.no_grad():
+            ((results_3, _),) = runner.run_scenarios(
+                "2022-02-08", [default_policies], seeds=[0]
+            )
+        assert torch.equal(
+            results_1["cases_per_timestep"][fork_step:],
+            results_3["cases_per_timestep"][fork_step:],
+        )
+
+    def test__lazy_infection_parameters(self):
+        with open(default_config_path, "r") as f:
+            parameters = yaml.safe_load(f)
+        parameters["system"]["lazy_infection_parameters"] = True
+        parameters["system"]["inference"] = True
+        runner = Runner.from_parameters(parameters)
+        inf_params = runner.data["agent"].infection_parameters
+        assert inf_params.n_drawn == 0
+        results, is_infected = runner()
+        assert len(results["cases_per_timestep"]) == 16
+        # only the agents infected before the last step were drawn
+        assert 0 < inf_params.n_drawn <= is_infected.sum()
+        # differentiable runs draw the parameters of all the agents
+        parameters["system"]["inference"] = False
+        with pytest.warns(UserWarning, match="only used in inference"):
+            runner = Runner.from_parameters(parameters)
+        inf_params = runner.data["agent"].infection_parameters
+        assert isinstance(inf_params, dict)
+        assert inf_params["shape"].shape == (runner.n_agents,)
 
     def test__save_results(self, runner):
         with torch.no_grad():
@@ -2,7 +2,7 @@ from pytest import fixture
 import numpy as np
 import torch
 
-from grad_june.symptoms import SymptomsSampler, SymptomsUpdater
+from grad_june.symptoms import CalendarQueue, SymptomsSampler, SymptomsUpdater
 
 
 class TestSymptomsSampler:
@@ -154,6 +154,60 @@ class TestSymptomsSampler:
         assert np.isclose(stage_times[4], 0.1, rtol=1e-1)
         assert stage_times[5] == 0.5
 
+    def test__sample_transitioning_only(self, sp, monkeypatch):
+        n_draws = []
+        sample_stage_times = sp._sample_stage_times
+
+        def counting_sample_stage_times(stages, recovers):
+            n_draws.append(len(stages))
+            return sample_stage_times(stages, recovers)
+
+        monkeypatch.setattr(sp, "_sample_stage_times", counting_sample_stage_times)
+        torch.manual_seed(0)
+        ages = torch.tensor([0, 20, 40, 60, 80, 99])
+        current_stage = torch.tensor([0, 1, 2, 3, 4, 5])
+        next_stage = torch.tensor([0, 1, 3, 4, 5, 5], dtype=torch.float)
+        next_stage.requires_grad_()
+        time_to_next_stage = torch.tensor([1.1, 2.5, 0.7, 0.9, 0.1, 0.5])
+        current, next, stage_time = sp.sample_next_stage(
+            ages, current_stage, next_stage, time_to_next_stage, 1.0
+        )
+        # agents 2 and 3 move to stages 3 and 4, which have stage times
+        assert n_draws == [2]
+        assert (stage_time[[0, 1, 4, 5]] == time_to_next_stage[[0, 1, 4, 5]]).all()
+        assert (stage_time[[2, 3]] > time_to_next_stage[[2, 3]]).all()
+        stage_time.sum().backward()
+        assert (next_stage.grad[[2, 3]] != 0).all()
+
+    def test__stacked_stage_times(self, sp, input):
+        table = sp.stage_times_table
+        assert table["is_log"][0].tolist() == [0, 0, 1, 0, 1, 0]
+        assert table["is_log"][1].tolist() == [0, 0, 1, 1, 1, 0]
+        assert np.isclose(table["loc"][0, 3].item(), 10.2)
+        assert np.isclose(table["scale"][1, 4].item(), 0.8)
+        n = 20000
+        stages = torch.tensor([2, 3, 4]).repeat(2 * n)
+        recovers = torch.tensor([False] * 3 * n + [True] * 3 * n)
+        # other distributions are sampled stage by stage
+        input["recovery_times"]["critical"] = {
+            "dist": "Gamma",
+            "concentration": 2.0,
+            "rate": 0.5,
+        }
+        params = {"system": {"device": "cpu"}, "symptoms": input}
+        sp_gamma = SymptomsSampler.from_parameters(params)
+        assert sp_gamma.stage_times_table is None
+        for sampler in (sp, sp_gamma):
+            times = sampler._sample_stage_times(stages, recovers)
+            means = times.reshape(2, n, 3).mean(1)
+            for i in range(3):
+                expected = sampler.stage_transition_times[i + 2].mean.item()
+                assert np.isclose(means[0, i].item(), expected, rtol=5e-2)
+                expected = sampler.recovery_times[i + 2].mean.item()
+                assert np.isclose(means[1, i].item(), expected, rtol=5e-2)
+        times = sp._sample_stage_times(torch.tensor([0, 1, 5]), torch.ones(3))
+        assert (times == 0).all()
+
 
 class TestSymptomsUpdater:
     @fixture(name="sp")
@@ -185,6 +239,59 @@ class TestSymptomsUpdater:
         assert will_symptom > n_agents / 2
         assert will_recover + will_symptom == n_agents
 
+    def test__update_symptoms_in_place(self, su, data, timer):
+        n_agents = len(data["agent"].id)
+        current_stage = 2 * torch.ones(n_agents, dtype=torch.long)
+        data["agent"]["symptoms"]["current_stage"] = current_stage
+        data["agent"]["symptoms"]["next_stage"] = 3 * torch.ones(
+            n_agents, dtype=torch.long
+        )
+        data["agent"]["symptoms"]["time_to_next_stage"] = torch.zeros(n_agents)
+        with torch.inference_mode():
+            symptoms = su.update_(
+                data=data,
+                timer=timer,
+                new_infected=torch.zeros(n_agents, dtype=torch.bool),
+            )
+        assert symptoms["current_stage"] is current_stage
+        assert (symptoms["current_stage"] == 3).all()
+        will_recover = (symptoms["next_stage"] == 0).sum()
+        will_symptom = (symptoms["next_stage"] == 4).sum()
+        assert will_recover < n_agents / 2
+        assert will_symptom > n_agents / 2
+        assert will_recover + will_symptom == n_agents
+        assert (symptoms["time_to_next_stage"] > 0).all()
+
+    def test__calendar_queue(self, sp, data, timer):
+        sp.calendar_queue = CalendarQueue()
+        su = SymptomsUpdater(sp)
+        n_agents = len(data["agent"].id)
+        last_stage = len(sp.stages) - 1
+        symptoms = data["agent"]["symptoms"]
+        symptoms["current_stage"] = torch.ones(n_agents, dtype=torch.long)
+        symptoms["next_stage"] = torch.ones(n_agents, dtype=torch.long)
+        symptoms["time_to_next_stage"] = torch.zeros(n_agents)
+        new_infected = torch.zeros(n_agents, dtype=torch.bool)
+        new_infected[: n_agents // 2] = True
+        with torch.inference_mode():
+            for _ in range(50):
+                next_stage = symptoms["next_stage"].clone()
+                next_stage[new_infected] = 2
+                time_to_next_stage = symptoms["time_to_next_stage"].clone()
+                time_to_next_stage[new_infected] = timer.now
+                current_stage = symptoms["current_stage"].clone()
+                # same transitions as scanning all the agents
+                mask_transition = (time_to_next_stage <= timer.now) & (
+                    current_stage < last_stage
+                )
+                expected = torch.where(mask_transition, next_stage, current_stage)
+                symptoms = su.update_(data=data, timer=timer, new_infected=new_infected)
+                assert (symptoms["current_stage"] == expected).all()
+                new_infected = torch.zeros(n_agents, dtype=torch.bool)
+                next(timer)
+        assert (symptoms["current_stage"][n_agents // 2 :] == 1).all()
+        assert (symptoms["current_stage"][: n_agents // 2] != 1).all()
+
     def test__dead_stay_dead(self, su, data, timer):
         n_agents = len(data["agent"].id)
         data["agent"]["symptoms"]["current_stage"] = 6 * torch.ones(
@@ -148,3 +148,15 @@ class TestTimer:
         assert timer.get_activity_order() == [
             "household",
         ]
+
+    def test__total_timesteps(self, timer):
+        next(timer)
+        # 8 weekdays of two steps and 2 weekend days of one step
+        assert timer.get_total_timesteps() == 18
+        assert timer.now == 0.5
+        timer.reset()
+        n_timesteps = 0
+        while timer.date < timer.final_date:
+            next(timer)
+            n_timesteps += 1
+        assert n_timesteps == 18
@@ -1,8 +1,16 @@
+import pickle
 import numpy as np
+import pytest
 import torch
 from pytest import fixture
 
-from grad_june.transmission import TransmissionUpdater
+from grad_june.transmission import (
+    GammaKernel,
+    InfectiousnessKernel,
+    LazyInfectionParameters,
+    TabulatedGammaKernel,
+    TransmissionUpdater,
+)
 
 
 class TestInfections:
@@ -31,3 +39,139 @@ class TestInfections:
         assert (transmissions[1:99] == torch.zeros(98)).all()
         assert transmissions[0] > 0.0
         assert transmissions[99] > 0.0
+
+    def test__infected_only(self, data, timer):
+        trans_updater = TransmissionUpdater()
+        is_infected = torch.zeros(100)
+        is_infected[::3] = 1.0
+        data["agent"].is_infected = is_infected
+        data["agent"].infection_time = -torch.rand(100)
+        while timer.now < 3:
+            next(timer)
+        expected = trans_updater(data=data, timer=timer)
+        assert (expected[is_infected == 1] > 0).all()
+        with torch.no_grad():
+            transmissions = trans_updater(data=data, timer=timer)
+            assert torch.allclose(transmissions, expected)
+            # the buffer is reused in the next step
+            next(timer)
+            next_transmissions = trans_updater(data=data, timer=timer)
+            assert next_transmissions is transmissions
+            assert (next_transmissions[is_infected == 0] == 0).all()
+
+    def test__lazy_parameters(self, sampler):
+        params = LazyInfectionParameters(sampler, (2, 1000), seed=3)
+        agents = torch.tensor([1500, 7, 42])
+        drawn = params.gather(agents)
+        assert params.n_drawn == 3
+        # values do not depend on the order in which agents are drawn
+        other = LazyInfectionParameters(sampler, (2, 1000), seed=3)
+        other.gather(torch.tensor([42]))
+        assert torch.equal(other.gather(agents)["shape"], drawn["shape"])
+        assert other.n_drawn == 3
+        # and match the values of all the agents
+        for key in params.keys:
+            assert torch.equal(params[key].reshape(-1)[agents], drawn[key])
+            assert params[key].shape == (2, 1000)
+        assert np.isclose(params["shape"].mean().item(), 1.56, rtol=1e-2)
+        assert np.isclose(params["shift"].mean().item(), -2.12, rtol=1e-2)
+        different_seed = LazyInfectionParameters(sampler, (2, 1000), seed=4)
+        assert not torch.equal(different_seed["rate"], params["rate"])
+
+    def test__lazy_parameters_pickle(self, sampler):
+        params = LazyInfectionParameters(sampler, (1000,), seed=3)
+        params.gather(torch.tensor([7, 42]))
+        shape = params["shape"]
+        loaded = pickle.loads(pickle.dumps(params))
+        # the dense values are left out, the drawn table is kept
+        assert loaded._values == {}
+        assert params["shape"] is shape
+        assert loaded.n_drawn == 2
+        assert torch.equal(loaded.table, params.table)
+        assert torch.equal(loaded["shape"], shape)
+
+    def test__lazy_parameters_transmission(self, sampler, data, timer):
+        params = LazyInfectionParameters(sampler, (100,), seed=0)
+        data["agent"].infection_parameters = params
+        is_infected = torch.zeros(100)
+        is_infected[::3] = 1.0
+        data["agent"].is_infected = is_infected
+        data["agent"].infection_time = -torch.rand(100)
+        while timer.now < 3:
+            next(timer)
+        trans_updater = TransmissionUpdater()
+        with torch.no_grad():
+            transmissions = trans_updater(data=data, timer=timer)
+        assert params.n_drawn == int(is_infected.sum())
+        expected = trans_updater(data=data, timer=timer)
+        assert torch.allclose(transmissions, expected)
+
+    def test__tabulated_kernel(self, sampler):
+        torch.manual_seed(0)
+        n_bins = 32
+        kernel = TabulatedGammaKernel(sampler.shape, sampler.rate, n_bins=n_bins)
+        gamma = GammaKernel()
+        shape = sampler.shape.sample((1000,))
+        rate = sampler.rate.sample((1000,))
+        time_from_shift = 12 * torch.rand(1000) - 1.0
+        expected = gamma(
+            time_from_shift, shape, rate, gamma.compute_constants(shape, rate)
+        )
+        time_from_shift.requires_grad_()
+        profile = kernel(
+            time_from_shift, shape, rate, kernel.get_constants(shape, rate)
+        )
+        assert (profile[time_from_shift <= 0] == 0).all()
+        # interpolation error, against the profile of the cluster centres
+        (clusters,) = kernel.get_constants(shape, rate)
+        centres = (torch.arange(n_bins) + 0.5) / n_bins
+        centre_shape = sampler.shape.icdf(centres)[clusters // n_bins]
+        centre_rate = sampler.rate.icdf(centres)[clusters % n_bins]
+        centre_profile = gamma(
+            time_from_shift.detach(),
+            centre_shape,
+            centre_rate,
+            gamma.compute_constants(centre_shape, centre_rate),
+        )
+        after_first_step = time_from_shift.detach() > kernel.time_step
+        assert torch.allclose(
+            profile[after_first_step], centre_profile[after_first_step], atol=1e-2
+        )
+        assert torch.allclose(profile, centre_profile, atol=5e-2)
+        # clustering error, against the profile of each agent
+        assert (profile - expected).abs().mean() < 2e-3
+        # the derivative is the slope of the table
+        profile.sum().backward()
+        h = 1e-3
+        with torch.no_grad():
+            constants = kernel.get_constants(shape, rate)
+            shifted = kernel(time_from_shift + h, shape, rate, constants)
+            slope = (shifted - profile) / h
+        inside = time_from_shift.detach() > 0
+        assert torch.allclose(time_from_shift.grad[inside], slope[inside], atol=1e-1)
+
+    def test__custom_kernel(self, data, timer):
+        class StepKernel(GammaKernel):
+            def __call__(self, time_from_shift, shape, rate, constants):
+                return (time_from_shift > 0).float()
+
+        trans_updater = TransmissionUpdater(kernel=StepKernel())
+        data["agent"].is_infected = torch.ones(100)
+        data["agent"].infection_time = torch.zeros(100)
+        while timer.now < 3:
+            next(timer)
+        transmissions = trans_updater(data=data, timer=timer)
+        max_infectiousness = data["agent"].infection_parameters["max_infectiousness"]
+        assert torch.allclose(transmissions, max_infectiousness)
+
+    def test__abstract_kernel(self):
+        class NoProfileKernel(InfectiousnessKernel):
+            pass
+
+        with pytest.raises(TypeError):
+            NoProfileKernel()
+
+    def test__unknown_kernel(self):
+        params = {"system": {"device": "cpu", "infectiousness_kernel": "spline"}}
+        with pytest.raises(ValueError, match="gamma"):
+            TransmissionUpdater.from_parameters(params)
@@ -11,6 +11,12 @@ from grad_june.utils import (
     fix_seed,
     read_path,
     create_simple_connected_graph,
+    cast_indices,
+    get_dtype,
+    add_group_indices,
+    get_propagation_index,
+    drop_reverse_edges,
+    get_reverse_edge_index,
 )
 from grad_june.paths import grad_june_path
 
@@ -79,3 +85,61 @@ class TestCreateSimpleGraph:
         #    assert data["agent"]["is_infected"][i] == 0
         #    assert data["agent"]["infection_time"][i] == 0.0
         #    assert data["agent"]["symptoms"]["next_stage"][i] == 1.0
+
+
+class TestCompactStorage:
+    def test__cast_indices(self):
+        data = create_simple_connected_graph(100)
+        data["agent"].household_group_index = torch.zeros(100, dtype=torch.long)
+        data = cast_indices(data, torch.int32)
+        for edge_type in data.edge_types:
+            assert data[edge_type].edge_index.dtype == torch.int32
+        assert data["agent"].household_group_index.dtype == torch.int32
+
+    def test__add_group_indices(self):
+        data = create_simple_connected_graph(100)
+        data["agent", "attends_school", "school"].edge_index = torch.tensor(
+            [[0, 1, 2], [0, 0, 1]]
+        )
+        data["agent", "attends_leisure", "leisure"].edge_index = torch.tensor(
+            [[0, 1], [0, 1]]
+        )
+        data = add_group_indices(data)
+        school_group_index = data["agent"].school_group_index
+        assert (school_group_index[:3] == torch.tensor([0, 0, 1])).all()
+        assert (school_group_index[3:] == -1).all()
+        assert "leisure_group_index" not in data["agent"]
+        # agents attending several groups get no index
+        data["agent", "attends_company", "company"].edge_index = torch.tensor(
+            [[0, 0], [0, 1]]
+        )
+        data = add_group_indices(data)
+        assert "company_group_index" not in data["agent"]
+
+    def test__get_propagation_index(self):
+        edge_index = torch.tensor([[0, 1, 2], [0, 0, 1]])
+        assert get_propagation_index(edge_index) is edge_index
+        rev_edge_index = get_propagation_index(edge_index, reverse=True)
+        assert (rev_edge_index == edge_index.flip(0)).all()
+        assert get_propagation_index(edge_index, reverse=True) is rev_edge_index
+        edge_index = edge_index.int()
+        long_edge_index = get_propagation_index(edge_index)
+        assert long_edge_index.dtype == torch.long
+        assert get_propagation_index(edge_index) is long_edge_index
+
+    def test__drop_reverse_edges(self):
+        data = create_simple_connected_graph(100)
+        rev_edge_index = data["rev_attends_household"].edge_index
+        data = drop_reverse_edges(data)
+        assert not any(edge_type[1].startswith("rev_") for edge_type in data.edge_types)
+        ret = get_reverse_edge_index(data, "attends_household")
+        assert (ret == rev_edge_index).all()
+        assert get_reverse_edge_index(data, "attends_household") is ret
+
+    def test__get_dtype(self):
+        assert get_dtype("int8") == torch.int8
+        assert get_dtype("bfloat16") == torch.bfloat16
+        with pytest.raises(ValueError):
+            get_dtype("float")
+        with pytest.raises(ValueError):
+            get_dtype("float31")